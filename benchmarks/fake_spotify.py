@@ -0,0 +1,215 @@
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+GROUPS = ['album', 'single', 'compilation', 'appears_on']
+
+
+def get_id(prefix, number):
+    # Same shape as spotify ids (22 alphanumeric characters)
+    return f'{prefix}{number:0{22 - len(prefix)}d}'
+
+
+class FakeSpotify:
+    def __init__(self, base_url, artists=100, shows=10, releases=3, episodes=5, latency=0, throttle_rate=0,
+                 retry_after=1, seed=0):
+        self.base_url = base_url
+        self.artists = artists
+        self.shows = shows
+        self.releases = releases
+        self.episodes = episodes
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__stats = {'requests': 0, 'throttled': 0}
+
+    def get_stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+    def wait(self):
+        with self.__lock:
+            self.__stats['requests'] += 1
+            latency = self.latency * self.__random.uniform(0.5, 1.5)
+            throttled = self.__random.random() < self.throttle_rate
+
+            if throttled:
+                self.__stats['throttled'] += 1
+
+        time.sleep(latency)
+        return throttled
+
+    def get_date(self, days_ago):
+        return (self.today - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+
+    def get_page(self, path, query, items, total, limit, offset):
+        next_url = None
+
+        if offset + limit < total:
+            next_query = query | {'offset': offset + limit, 'limit': limit}
+            next_url = f'{self.base_url}{path}?{"&".join(f"{key}={value}" for key, value in next_query.items())}'
+
+        return {'href': f'{self.base_url}{path}', 'items': items, 'limit': limit, 'offset': offset, 'total': total,
+                'next': next_url, 'previous': None}
+
+    def get_images(self, name):
+        return [{'url': f'https://i.scdn.co/image/{name}_{size}', 'height': size, 'width': size}
+                for size in [640, 300, 64]]
+
+    def get_artist(self, number):
+        artist_id = get_id('ar', number)
+        return {'id': artist_id, 'name': f'Artist {number}', 'type': 'artist', 'popularity': number % 100,
+                'genres': ['benchmark'], 'followers': {'href': None, 'total': number},
+                'external_urls': {'spotify': f'https://open.spotify.com/artist/{artist_id}'},
+                'images': self.get_images(artist_id), 'uri': f'spotify:artist:{artist_id}'}
+
+    def get_release(self, artist_number, group, number):
+        release_id = get_id(f'al{GROUPS.index(group)}', artist_number * self.releases + number)
+        artist = self.get_artist(artist_number)
+
+        return {'id': release_id, 'name': f'Release {number} of artist {artist_number}', 'album_type': group,
+                'album_group': group, 'total_tracks': 10, 'release_date_precision': 'day',
+                # Releases are spread over the last 60 days, some are older than newer_than
+                'release_date': self.get_date((artist_number + number * 7) % 60),
+                'available_markets': ['FR', 'DE', 'GB', 'US', 'JP', 'BR', 'CA', 'ES', 'IT'] * 20,
+                'external_urls': {'spotify': f'https://open.spotify.com/album/{release_id}'},
+                'images': self.get_images(release_id), 'uri': f'spotify:album:{release_id}', 'type': 'album',
+                'artists': [{'id': artist.get('id'), 'name': artist.get('name'), 'type': 'artist',
+                             'external_urls': artist.get('external_urls'), 'uri': artist.get('uri')}]}
+
+    def get_show(self, number):
+        show_id = get_id('sh', number)
+        return {'added_at': (self.today - timedelta(days=number % 365)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'show': {'id': show_id, 'name': f'Show {number}', 'publisher': 'Benchmark', 'total_episodes': 100,
+                         'description': 'A show used for benchmarks', 'available_markets': ['FR', 'US'] * 90,
+                         'external_urls': {'spotify': f'https://open.spotify.com/show/{show_id}'},
+                         'images': self.get_images(show_id), 'uri': f'spotify:show:{show_id}'}}
+
+    def get_episode(self, show_number, number):
+        episode_id = get_id('ep', show_number * 1000 + number)
+        return {'id': episode_id, 'name': f'Episode {number} of show {show_number}', 'duration_ms': 1800000,
+                'release_date': self.get_date(number * 3), 'release_date_precision': 'day',
+                'description': 'Episode description. ' * 40, 'html_description': '<p>Episode description.</p>' * 40,
+                'external_urls': {'spotify': f'https://open.spotify.com/episode/{episode_id}'},
+                'images': self.get_images(episode_id), 'uri': f'spotify:episode:{episode_id}'}
+
+    def handle(self, method, url):
+        path = urlparse(url).path
+        query = {key: values[0] for key, values in parse_qs(urlparse(url).query).items()}
+        limit = int(query.get('limit', 20))
+        offset = int(query.get('offset', 0))
+        parts = path.strip('/').split('/')
+
+        if method == 'POST' and path == '/api/token':
+            return 200, {'access_token': f'benchmark_{time.time()}', 'token_type': 'Bearer', 'expires_in': 3600,
+                         'refresh_token': 'benchmark', 'scope': 'user-follow-read user-library-read'}
+
+        if path == '/v1/me/following':
+            # Followed artists are paginated with the id of the last artist of the previous page
+            start = int(query.get('after')[2:]) + 1 if 'after' in query else 0
+            items = [self.get_artist(number) for number in range(start, min(start + limit, self.artists))]
+            after = get_id('ar', start + limit - 1) if start + limit < self.artists else None
+            next_url = None if after is None else f'{self.base_url}{path}?type=artist&limit={limit}&after={after}'
+
+            return 200, {'artists': {'href': f'{self.base_url}{path}', 'items': items, 'limit': limit,
+                                     'next': next_url, 'total': self.artists, 'cursors': {'after': after}}}
+
+        if path == '/v1/me/shows':
+            items = [self.get_show(number) for number in range(offset, min(offset + limit, self.shows))]
+            return 200, self.get_page(path, query, items, self.shows, limit, offset)
+
+        if len(parts) == 4 and parts[1] == 'artists' and parts[3] == 'albums':
+            artist_number = int(parts[2][2:])
+            releases = [self.get_release(artist_number, group, number)
+                        for group in query.get('include_groups', ','.join(GROUPS)).split(',') if group in GROUPS
+                        for number in range(self.releases)]
+            # Like spotify, groups come one after the other (in GROUPS order), newest first within a group
+            releases.sort(key=lambda release: release.get('release_date'), reverse=True)
+            releases.sort(key=lambda release: GROUPS.index(release.get('album_group')))
+
+            return 200, self.get_page(path, query, releases[offset:offset + limit], len(releases), limit, offset)
+
+        if len(parts) == 4 and parts[1] == 'shows' and parts[3] == 'episodes':
+            show_number = int(parts[2][2:])
+            items = [self.get_episode(show_number, number)
+                     for number in range(offset, min(offset + limit, self.episodes))]
+
+            return 200, self.get_page(path, query, items, self.episodes, limit, offset)
+
+        return 404, {'error': {'status': 404, 'message': 'Service not found'}}
+
+
+def create_server(port=0, **options):
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.fake = FakeSpotify(base_url=f'http://127.0.0.1:{server.server_address[1]}', **options)
+
+    return server
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real api, so that the connection pool is exercised
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would delay every response by the peer delayed ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self.send_json(200, self.server.fake.get_stats())
+
+        self.respond('GET')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.respond('POST')
+
+    def respond(self, method):
+        if self.server.fake.wait():
+            return self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                  headers={'Retry-After': str(self.server.fake.retry_after)})
+
+        self.send_json(*self.server.fake.handle(method, self.path))
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in of the spotify endpoints used by the tracker')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--artists', type=int, default=100)
+    parser.add_argument('--shows', type=int, default=10)
+    parser.add_argument('--releases', type=int, default=3, help='releases per artist and per group')
+    parser.add_argument('--episodes', type=int, default=5, help='episodes per show')
+    parser.add_argument('--latency', type=float, default=0, help='mean response time in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    arguments = parser.parse_args()
+
+    fake_server = create_server(port=arguments.port, artists=arguments.artists, shows=arguments.shows,
+                                releases=arguments.releases, episodes=arguments.episodes, latency=arguments.latency,
+                                throttle_rate=arguments.throttle_rate, retry_after=arguments.retry_after)
+    print(f'Fake spotify listening on {fake_server.fake.base_url}', flush=True)
+    fake_server.serve_forever()
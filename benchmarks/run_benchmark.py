@@ -0,0 +1,267 @@
+import argparse
+import configparser
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCHMARKS_PATH)
+
+
+def get_free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def get_peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def get_latencies(durations):
+    durations = sorted(durations)
+
+    return {
+        'requests': len(durations),
+        'p50_ms': round(statistics.median(durations) * 1000, 2),
+        'p95_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 2),
+        'max_ms': round(durations[-1] * 1000, 2),
+        'requests_per_second': round(len(durations) / sum(durations), 1)
+    }
+
+
+def prepare_workdir(config):
+    workdir = tempfile.mkdtemp(prefix='spotify_tracker_benchmark_')
+
+    for directory in ['params', 'data', 'logs']:
+        os.makedirs(f'{workdir}/{directory}')
+
+    # Feeds are written into static, the repository copy must stay untouched
+    os.symlink(f'{ROOT_PATH}/templates', f'{workdir}/templates')
+    shutil.copytree(f'{ROOT_PATH}/static', f'{workdir}/static')
+
+    app_config = configparser.ConfigParser(interpolation=None)
+    app_config.read(f'{ROOT_PATH}/params/params.ini')
+    app_config['app'].update({
+        'client_id': 'benchmark',
+        'client_secret': 'benchmark',
+        'spotify_api_url': f'{config.get("fake_url")}/v1',
+        'spotify_accounts_url': config.get('fake_url'),
+        'log_level': 'WARNING',
+        'delay': '0',
+        'include_groups': 'album,single,compilation',
+        'storage_backend': config.get('storage'),
+        'max_concurrency': str(config.get('concurrency')),
+        'rate_limit': str(config.get('rate_limit')),
+        'http_pool_size': str(max(10, config.get('concurrency')))
+    })
+
+    with open(f'{workdir}/params/params.ini', 'w') as params_file:
+        app_config.write(params_file)
+
+    return workdir
+
+
+def measure(phase, results, trace_memory, function):
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    function()
+    results[phase] = {'seconds': round(time.perf_counter() - start, 3)}
+
+    if trace_memory:
+        results[phase]['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+
+    results[phase]['peak_rss_mb'] = get_peak_rss_mb()
+
+
+def run_child(config):
+    workdir = prepare_workdir(config)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT_PATH)
+
+    import spotify_api_helpers as api
+    import page_renderer
+    import rss_feed_generator
+    import spotify_tracker_api as web
+    from response_cache import ResponseCache
+
+    import uvicorn
+
+    results = {}
+
+    def get_fake_stats():
+        return requests.get(f'{config.get("fake_url")}/stats').json()
+
+    api.request_access_token('benchmark')
+
+    for phase in ['scan', 'rescan']:
+        before = get_fake_stats()
+        measure(phase, results, config.get('trace_memory'), api.perform_full_search)
+        after = get_fake_stats()
+
+        results[phase] |= {
+            'spotify_requests': after.get('requests') - before.get('requests'),
+            'throttled': after.get('throttled') - before.get('throttled'),
+            'artists_per_second': round(config.get('artists') / results[phase].get('seconds'), 1),
+            'requests_per_second': round((after.get('requests') - before.get('requests')) /
+                                         results[phase].get('seconds'), 1)
+        }
+
+    measure('feeds', results, config.get('trace_memory'), rss_feed_generator.generate_feed)
+    measure('pages', results, config.get('trace_memory'), page_renderer.generate_pages)
+
+    results['library'] = {'artists': len(api.get_artists()), 'releases': len(api.get_releases()),
+                          'shows': len(api.get_shows()), 'episodes': len(api.get_episodes())}
+
+    port = get_free_port()
+    server = uvicorn.Server(uvicorn.Config(web.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    routes = {
+        'releases': '/releases',
+        'releases_sorted_by_name': '/releases?sort_by=name&reverse_sort=false',
+        'latest': '/api/latest?from=2000-01-01',
+        'api_releases_page': '/api/releases?limit=50&sort_by=release_date_timestamp&reverse_sort=true'
+    }
+
+    results['web'] = {}
+
+    with requests.Session() as client:
+        for name, route in routes.items():
+            results['web'][name] = {}
+
+            # Cold requests build the response, warm ones are served by the response cache
+            for mode in ['cold', 'warm']:
+                durations = []
+
+                for _ in range(config.get('web_requests')):
+                    if mode == 'cold':
+                        web.response_cache = ResponseCache()
+
+                    start = time.perf_counter()
+                    client.get(f'http://127.0.0.1:{port}{route}').raise_for_status()
+                    durations.append(time.perf_counter() - start)
+
+                results['web'][name][mode] = get_latencies(durations)
+
+    server.should_exit = True
+    results['peak_rss_mb'] = get_peak_rss_mb()
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def run(config):
+    port = get_free_port()
+    config = config | {'fake_url': f'http://127.0.0.1:{port}'}
+
+    fake = subprocess.Popen([sys.executable, f'{BENCHMARKS_PATH}/fake_spotify.py', '--port', str(port),
+                             '--artists', str(config.get('artists')), '--shows', str(config.get('shows')),
+                             '--latency', str(config.get('latency')),
+                             '--throttle-rate', str(config.get('throttle_rate'))],
+                            stdout=subprocess.PIPE, text=True)
+
+    try:
+        # The fake prints a line once it listens
+        fake.stdout.readline()
+
+        # Each library size runs in its own process, module state and peak memory are not shared
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                               stdout=subprocess.PIPE, text=True, check=True)
+
+        return json.loads(child.stdout.splitlines()[-1])
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def flatten(results, prefix=''):
+    flat = {}
+
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat |= flatten(value, f'{prefix}{key}.')
+        else:
+            flat[f'{prefix}{key}'] = value
+
+    return flat
+
+
+def report(results, baseline=None):
+    for size, size_results in results.items():
+        print(f'\n== {size} artists')
+        baseline_results = flatten((baseline or {}).get(size, {}))
+
+        for key, value in flatten(size_results).items():
+            line = f'{key:<55} {value:>12}'
+
+            if isinstance(baseline_results.get(key), (int, float)) and baseline_results.get(key) != 0:
+                line += f' ({(value - baseline_results.get(key)) / baseline_results.get(key):+.1%})'
+
+            print(line)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        child_results = run_child(json.loads(sys.argv[2]))
+        print(json.dumps(child_results))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmark scans, pages and feeds against a local fake spotify')
+    parser.add_argument('--artists', default='100,1000', help='comma separated library sizes, ex : 100,1000,50000')
+    parser.add_argument('--shows', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='mean spotify response time in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='share of requests answered with a 429')
+    parser.add_argument('--concurrency', type=int, default=4, help='max_concurrency used by the scans')
+    parser.add_argument('--rate-limit', type=int, default=0, help='rate_limit used by the scans, 0 disables it')
+    parser.add_argument('--storage', choices=['tinydb', 'sqlite'], default='tinydb')
+    parser.add_argument('--web-requests', type=int, default=20, help='requests sent to each page')
+    parser.add_argument('--trace-memory', action='store_true', help='report python allocations peak (slower)')
+    parser.add_argument('--output', help='json file where the results are written')
+    parser.add_argument('--baseline', help='json file of a previous run to compare with')
+    arguments = parser.parse_args()
+
+    all_results = {}
+
+    for artists in [int(size) for size in arguments.artists.split(',')]:
+        all_results[str(artists)] = run({
+            'artists': artists,
+            'shows': arguments.shows,
+            'latency': arguments.latency,
+            'throttle_rate': arguments.throttle_rate,
+            'concurrency': arguments.concurrency,
+            'rate_limit': arguments.rate_limit,
+            'storage': arguments.storage,
+            'web_requests': arguments.web_requests,
+            'trace_memory': arguments.trace_memory
+        })
+
+    baseline_results = None
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)
+
+    report(all_results, baseline_results)
+
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(all_results, output_file, indent=2)
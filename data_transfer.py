@@ -0,0 +1,95 @@
+import argparse
+import json
+import sys
+
+import page_renderer
+import rss_feed_generator
+import spotify_api_helpers as api
+
+EXPORTED_TABLES = ['artists', 'releases', 'shows', 'episodes']
+IMPORT_BATCH_SIZE = 500
+
+params = api.get_parameters()
+logging = params.get_logger()
+
+
+def get_tables(tables=None):
+    if tables is None:
+        return EXPORTED_TABLES
+
+    for table in tables:
+        if table not in EXPORTED_TABLES:
+            raise ValueError(f'Table {table} not in {EXPORTED_TABLES}')
+
+    return tables
+
+
+def export_lines(tables=None):
+    for table in get_tables(tables):
+        for document in api.get_databases().get(table).iterate():
+            yield json.dumps({'table': table, 'document': document}) + '\n'
+
+
+def import_lines(lines, batch_size=IMPORT_BATCH_SIZE):
+    databases = api.get_databases()
+    known_ids = {table: databases.get(table).get_ids() for table in EXPORTED_TABLES}
+    batches = {table: [] for table in EXPORTED_TABLES}
+    imported = {table: 0 for table in EXPORTED_TABLES}
+
+    def flush(table):
+        databases.get(table).insert_multiple(batches.get(table))
+        imported[table] += len(batches.get(table))
+        batches[table] = []
+
+    for line_number, line in enumerate(lines, start=1):
+        if len(line.strip()) == 0:
+            continue
+
+        try:
+            entry = json.loads(line)
+            table = entry.get('table')
+            document = entry.get('document')
+        except (ValueError, AttributeError):
+            raise ValueError(f'Line {line_number} is not a valid export entry')
+
+        if table not in EXPORTED_TABLES or not isinstance(document, dict):
+            raise ValueError(f'Line {line_number} is not a valid export entry')
+
+        # Entries already in the database are kept, importing twice is harmless
+        if document.get('id') in known_ids.get(table):
+            continue
+
+        known_ids.get(table).add(document.get('id'))
+        batches.get(table).append(document)
+
+        if len(batches.get(table)) >= batch_size:
+            flush(table)
+
+    for table in EXPORTED_TABLES:
+        if len(batches.get(table)) > 0:
+            flush(table)
+
+    api.update_metadata()
+    rss_feed_generator.generate_feed()
+    page_renderer.generate_pages()
+    logging.info(f'Import done : {imported}')
+
+    return imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import the tracker database as NDJSON')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', nargs='?', default='-', help='file to write or read, - for stdout or stdin')
+    parser.add_argument('--tables', help=f'comma separated tables to export, among {",".join(EXPORTED_TABLES)}')
+    arguments = parser.parse_args()
+
+    if arguments.command == 'export':
+        tables = None if arguments.tables is None else arguments.tables.split(',')
+        output = sys.stdout if arguments.file == '-' else open(arguments.file, 'w')
+
+        with output:
+            output.writelines(export_lines(tables))
+    else:
+        with sys.stdin if arguments.file == '-' else open(arguments.file) as source:
+            print(import_lines(source))
@@ -0,0 +1,56 @@
+import logging
+
+import spotify_api_helpers as api
+import storage
+
+# Multi-id endpoint and maximum number of ids per request
+ENDPOINTS = {
+    'releases': ('albums', 20),
+    'episodes': ('episodes', 50)
+}
+
+# Fields only returned by the full objects, merged into the simplified ones returned by the scans
+FIELDS = {
+    'releases': ['label', 'popularity', 'genres', 'copyrights.text', 'copyrights.type', 'external_ids.upc',
+                 'tracks.total'],
+    'episodes': ['explicit', 'languages', 'show.id', 'show.name', 'show.publisher']
+}
+
+
+def get_fields(type):
+    return FIELDS.get(type, []) if api.get_parameters().get('enrichment') else []
+
+
+def request_details(type, ids):
+    endpoint, batch_size = ENDPOINTS.get(type)
+    details = []
+
+    for start in range(0, len(ids), batch_size):
+        request = api.request_api(f'{api.api_url}/{endpoint}?ids={",".join(ids[start:start + batch_size])}')
+
+        if request is None or request.status_code != 200:
+            logging.warning(f'{type} : enrichment of {len(ids[start:start + batch_size])} entries failed - '
+                            f'{None if request is None else request.status_code}')
+            continue
+
+        details += [item for item in request.json().get(endpoint) if item is not None]
+
+    return details
+
+
+def enrich(type, items):
+    if not api.get_parameters().get('enrichment') or type not in ENDPOINTS or len(items) == 0:
+        return items
+
+    # Entries are already deduplicated by the scan, each id is requested once
+    ids = [item.get('id') for item in items]
+    details_by_id = {detail.get('id'): storage.project(detail, FIELDS.get(type))
+                     for detail in request_details(type, ids)}
+
+    logging.info(f'{type} : {len(details_by_id)}/{len(ids)} entries enriched')
+
+    for item in items:
+        item.update(details_by_id.get(item.get('id'), {}))
+
+    return items
+
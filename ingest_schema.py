@@ -0,0 +1,52 @@
+import gzip
+import json
+import os
+
+import enrichment
+import spotify_api_helpers as api
+import storage
+
+ARCHIVE_PATH = 'data/archive'
+
+# Fields read by the templates, the rss feed and the scans, timestamps and source ids are added after the projection
+SCHEMAS = {
+    'releases': ['id', 'name', 'album_type', 'album_group', 'total_tracks', 'release_date', 'release_date_precision',
+                 'external_urls.spotify', 'images.url', 'artists.id', 'artists.name', 'artists.external_urls.spotify'],
+    'episodes': ['id', 'name', 'description', 'duration_ms', 'release_date', 'release_date_precision',
+                 'external_urls.spotify', 'images.url'],
+    'shows': ['id', 'added_at', 'show.id', 'show.name', 'show.external_urls.spotify', 'show.images.url']
+}
+
+trees = {}
+
+
+def get_tree(type):
+    if type not in trees:
+        extra_fields = [field for field in api.get_parameters().get('ingest_extra_fields') if field != '']
+        trees[type] = storage.get_field_tree(SCHEMAS.get(type) + extra_fields + enrichment.get_fields(type))
+
+    return trees.get(type)
+
+
+def project(type, document):
+    if api.get_parameters().get('ingest_schema') == 'full' or type not in SCHEMAS:
+        # Every country code is listed in available_markets, it is never stored
+        document.pop('available_markets', None)
+
+        if isinstance(document.get('show'), dict):
+            document.get('show').pop('available_markets', None)
+
+        return document
+
+    return storage.project_tree(document, get_tree(type))
+
+
+def archive(type, documents):
+    if not api.get_parameters().get('raw_archive') or len(documents) == 0:
+        return
+
+    os.makedirs(ARCHIVE_PATH, exist_ok=True)
+
+    # Each call appends a gzip member, gzip.open reads the whole file back as a single stream
+    with gzip.open(f'{ARCHIVE_PATH}/{type}.ndjson.gz', 'at', encoding='utf-8') as raw_archive:
+        raw_archive.writelines(json.dumps(document) + '\n' for document in documents)
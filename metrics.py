@@ -0,0 +1,157 @@
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SPOTIFY_ID = re.compile(r'/[0-9A-Za-z]{22}(?=/|$)')
+
+
+def get_endpoint(url):
+    # Spotify ids are replaced so that every artist shares the same series
+    return SPOTIFY_ID.sub('/{id}', urlparse(url).path)
+
+
+class Metrics:
+    def __init__(self, enabled, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.__buckets = buckets
+        self.__counters = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.__lock:
+            # Bucket counts, then the sum and the count of the observations
+            histogram = self.__histograms.setdefault(key, [0] * (len(self.__buckets) + 2))
+
+            for index, bound in enumerate(self.__buckets):
+                if value <= bound:
+                    histogram[index] += 1
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return nullcontext()
+
+        return self.__time(name, labels)
+
+    @contextmanager
+    def __time(self, name, labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                'buckets': self.__buckets,
+                'counters': dict(self.__counters),
+                'histograms': {key: list(histogram) for key, histogram in self.__histograms.items()}
+            }
+
+
+def merge(*snapshots):
+    merged = {'buckets': DEFAULT_BUCKETS, 'counters': {}, 'histograms': {}}
+
+    for snapshot in snapshots:
+        merged['buckets'] = snapshot.get('buckets')
+
+        for key, value in snapshot.get('counters').items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+
+        for key, histogram in snapshot.get('histograms').items():
+            current = merged['histograms'].get(key, [0] * len(histogram))
+            merged['histograms'][key] = [a + b for a, b in zip(current, histogram)]
+
+    return merged
+
+
+def get_total(snapshot, name, **labels):
+    total = 0
+
+    for (key_name, key_labels), value in snapshot.get('counters').items():
+        if key_name == name and labels.items() <= dict(key_labels).items():
+            total += value
+
+    for (key_name, key_labels), histogram in snapshot.get('histograms').items():
+        if key_name == name and labels.items() <= dict(key_labels).items():
+            total += histogram[-2]
+
+    return total
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render(snapshot):
+    lines = []
+    typed = set()
+
+    for (name, labels), value in sorted(snapshot.get('counters').items()):
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+
+        lines.append(f'{name}{format_labels(labels)} {value}')
+
+    for (name, labels), histogram in sorted(snapshot.get('histograms').items()):
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+
+        for bound, count in zip(snapshot.get('buckets'), histogram):
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+
+        lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram[-1]}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram[-2]}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram[-1]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedTable:
+    def __init__(self, table, metrics):
+        self.name = table.name
+        self.__table = table
+        self.__metrics = metrics
+
+    def __getattr__(self, operation):
+        method = getattr(self.__table, operation)
+
+        # Generators are consumed after the call returns, timing the call would be meaningless
+        if not callable(method) or operation == 'iterate':
+            return method
+
+        def timed(*args, **kwargs):
+            with self.__metrics.timer('storage_operation_duration_seconds', table=self.name, operation=operation):
+                return method(*args, **kwargs)
+
+        return timed
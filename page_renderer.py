@@ -0,0 +1,65 @@
+import os
+
+import jinja2
+
+import spotify_api_helpers as api
+
+PAGES_PATH = 'data/pages'
+
+loader = jinja2.FileSystemLoader('./templates')
+env = jinja2.Environment(autoescape=True, loader=loader)
+
+
+def get_page_path(name, sort_by, reverse_sort):
+    return f'{PAGES_PATH}/{name}_{sort_by}_{"desc" if reverse_sort else "asc"}.html'
+
+
+def is_prerendered(sort_by):
+    return sort_by in api.get_parameters().get_metadata().get('fixed_values').get('default_sorting')
+
+
+def generate_pages():
+    os.makedirs(PAGES_PATH, exist_ok=True)
+
+    # Pages are only served between scans, the status is never displayed
+    context = {
+        'metadata': api.get_metadata(),
+        'app_params': api.get_parameters().get_all(),
+        'status': None
+    }
+
+    pages = {
+        'releases': context | {'artists': api.get_artists(), 'releases': api.get_releases()},
+        'episodes': context | {'episodes': api.get_episodes(), 'shows': api.get_shows()}
+    }
+
+    for name, page_context in pages.items():
+        template = env.get_template(f'{name}.html.j2')
+
+        for sort_by in api.get_parameters().get_metadata().get('fixed_values').get('default_sorting'):
+            for reverse_sort in [True, False]:
+                render = template.render(page_context | {'sort_by': sort_by, 'reverse_sort': reverse_sort})
+                path = get_page_path(name, sort_by, reverse_sort)
+
+                # Web workers may read the page while it is written
+                with open(f'{path}.tmp', 'w') as page:
+                    page.write(render)
+
+                os.replace(f'{path}.tmp', path)
+
+
+def read_page(name, sort_by, reverse_sort, generation):
+    if not is_prerendered(sort_by):
+        return None
+
+    path = get_page_path(name, sort_by, reverse_sort)
+
+    try:
+        # A page written before the scan was stamped belongs to the previous scan
+        if os.path.getmtime(path) < generation:
+            return None
+
+        with open(path) as page:
+            return page.read()
+    except OSError:
+        return None
@@ -8,6 +8,8 @@ default_params = {
     'cliend_id': None,
     'client_secret': None,
     'application_url': 'http://localhost:8000',
+    'spotify_api_url': 'https://api.spotify.com/v1',
+    'spotify_accounts_url': 'https://accounts.spotify.com',
 
     'listen_port': 8000,
     'listen_host': '0.0.0.0',
@@ -16,22 +18,54 @@ default_params = {
 
     'albums_request_limit': 5,
     'delay': 0,
+    'max_concurrency': 4,
+    'scan_batch_size': 50,
+    'rate_limit': 10,
+    'http_pool_size': 10,
+    'http_timeout': 30,
     'newer_than': 30,
     'default_sorting': 'release_date_timestamp',
+    'storage_backend': 'tinydb',
+    'scan_mode': 'embedded',
+    'scan_worker_port': 8001,
+    'scan_worker_timeout': 5,
+    'web_workers': 1,
+    'ws_max_rate': 4,
+    'ws_send_timeout': 2,
     'include_groups': ['album', 'single', 'compilation', 'appears_on'],
 
     'search_url_music': '',
     'search_url_shows': '',
 
-    'cron': '0 1 * * *'
+    'rss_max_items': 100,
+
+    'cron': '0 1 * * *',
+    'adaptive_scheduling': False,
+    'schedule_min_interval': 1,
+    'schedule_max_interval': 168,
+
+    'api_import': False,
+    'metrics': False,
+
+    'ingest_schema': 'minimal',
+    'ingest_extra_fields': [],
+    'raw_archive': False,
+    'enrichment': False
 }
 
 params_metadata = {
-    'int': ['newer_than', 'delay', 'listen_port', 'albums_request_limit', 'logs_rotation'],
-    'array': ['include_groups'],
+    'int': ['newer_than', 'delay', 'listen_port', 'albums_request_limit', 'logs_rotation',
+            'max_concurrency', 'rate_limit', 'http_pool_size', 'http_timeout', 'schedule_min_interval',
+            'schedule_max_interval', 'scan_worker_port', 'scan_worker_timeout', 'web_workers', 'rss_max_items', 'ws_max_rate',
+            'ws_send_timeout', 'scan_batch_size'],
+    'bool': ['adaptive_scheduling', 'api_import', 'raw_archive', 'metrics', 'enrichment'],
+    'array': ['include_groups', 'ingest_extra_fields'],
     'cannot_be_none': ['client_id', 'client_secret', 'application_url'],
     'fixed_values': {
-        'default_sorting': ['release_date_timestamp', 'added_date_timestamp']
+        'default_sorting': ['release_date_timestamp', 'added_date_timestamp'],
+        'storage_backend': ['tinydb', 'sqlite'],
+        'scan_mode': ['embedded', 'worker'],
+        'ingest_schema': ['minimal', 'full']
     }
 }
 
@@ -56,6 +90,12 @@ class ConfigManager:
                 except ValueError:
                     self.get_logger().error(
                         f'params.ini : Value {option} must be an integer, using default value ({default_params.get(option)}) instead')
+            elif option in params_metadata.get('bool'):
+                try:
+                    self.__parameters[option] = self.__app_config.getboolean(section='app', option=option)
+                except ValueError:
+                    self.get_logger().error(
+                        f'params.ini : Value {option} must be true or false, using default value ({default_params.get(option)}) instead')
             elif option in params_metadata.get('array'):
                 self.__parameters[option] = self.__app_config.get(section='app', option=option).split(',')
             else:
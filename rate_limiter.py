@@ -0,0 +1,74 @@
+import threading
+import time
+
+# Seconds without any 429 before the rate starts increasing again
+RECOVERY_DELAY = 10
+# Seconds needed to go back from the minimal rate to the configured rate
+RECOVERY_DURATION = 60
+# Several workers usually get a 429 for the same throttling window, they only count once
+THROTTLE_WINDOW = 1
+
+
+class RateLimiter:
+    def __init__(self, max_rate, min_rate=0.5):
+        self.__max_rate = max_rate
+        self.__min_rate = min(min_rate, max_rate) if max_rate > 0 else 0
+        self.__rate = max_rate
+        self.__tokens = max_rate
+        self.__last_refill = time.monotonic()
+        self.__last_throttle = 0
+        self.__blocked_until = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__refill(now)
+
+                wait = self.__blocked_until - now
+
+                if wait <= 0:
+                    if self.__max_rate <= 0:
+                        return
+
+                    if self.__tokens >= 1:
+                        self.__tokens = self.__tokens - 1
+                        return
+
+                    wait = (1 - self.__tokens) / self.__rate
+
+            time.sleep(wait)
+
+    def throttled(self, retry_after):
+        with self.__lock:
+            now = time.monotonic()
+            self.__blocked_until = max(self.__blocked_until, now + retry_after)
+            self.__tokens = 0
+
+            if now - self.__last_throttle > THROTTLE_WINDOW and self.__max_rate > 0:
+                self.__rate = max(self.__min_rate, self.__rate / 2)
+
+            self.__last_throttle = now
+
+    def get_rate(self):
+        return self.__rate
+
+    def __refill(self, now):
+        elapsed = now - self.__last_refill
+        self.__last_refill = now
+
+        if self.__max_rate <= 0:
+            return
+
+        if self.__rate < self.__max_rate and now - self.__last_throttle > RECOVERY_DELAY:
+            self.__rate = min(self.__max_rate, self.__rate + elapsed * self.__max_rate / RECOVERY_DURATION)
+
+        self.__tokens = min(max(1, self.__rate), self.__tokens + elapsed * self.__rate)
+
+
+def parse_retry_after(value, default=5):
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+class ResponseCache:
+    def __init__(self, max_entries=64):
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__generation = None
+        self.__lock = threading.Lock()
+
+    def respond(self, request, generation, build, variant=None):
+        key = f'{request.url.path}?{request.url.query}#{variant}'
+
+        with self.__lock:
+            # Every entry belongs to the previous scan once a new one is stamped
+            if generation != self.__generation:
+                self.__entries.clear()
+                self.__generation = generation
+
+            entry = self.__entries.get(key)
+
+            if entry is not None:
+                self.__entries.move_to_end(key)
+
+        if entry is None:
+            response = build()
+
+            if not isinstance(response, Response):
+                response = JSONResponse(jsonable_encoder(response))
+
+            # The etag comes from the body : data changed without a new generation, or another web worker holding a
+            # different body, never matches a stale etag
+            etag = f'"{hashlib.sha1(response.body).hexdigest()}"'
+            entry = (response.body, response.media_type, response.status_code, etag)
+
+            with self.__lock:
+                if generation == self.__generation:
+                    self.__entries[key] = entry
+
+                    while len(self.__entries) > self.__max_entries:
+                        self.__entries.popitem(last=False)
+
+        body, media_type, status_code, etag = entry
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(int(generation), usegmt=True),
+            'Cache-Control': 'no-cache'
+        }
+
+        if self.__is_not_modified(request, etag, generation):
+            return Response(status_code=304, headers=headers)
+
+        return Response(content=body, media_type=media_type, status_code=status_code, headers=headers)
+
+    @staticmethod
+    def __is_not_modified(request, etag, generation):
+        if_none_match = request.headers.get('if-none-match')
+
+        if if_none_match is not None:
+            return etag in [value.strip() for value in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+        if_modified_since = request.headers.get('if-modified-since')
+
+        if if_modified_since is not None:
+            try:
+                return int(generation) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
@@ -1,19 +1,131 @@
+import os
+
 import jinja2
 from datetime import datetime
 import spotify_api_helpers as api
 
-def generate_feed():
-    loader = jinja2.FileSystemLoader('./templates')
-    env = jinja2.Environment(autoescape=True, loader=loader)
+FEED_PATH = 'static/feed'
+FEEDS_PATH = 'static/feeds'
+
+loader = jinja2.FileSystemLoader('./templates')
+env = jinja2.Environment(autoescape=True, loader=loader)
+
+
+def get_newest(items):
+    sorting = api.get_parameters().get('default_sorting')
+    items = sorted(items, key=lambda item: item.get(sorting) or 0, reverse=True)
+
+    return items[:api.get_parameters().get('rss_max_items')]
+
+
+def get_artist_ids(release):
+    return {release.get('artist_id')} | {artist.get('id') for artist in release.get('artists') or []}
+
+
+def write_feed(path, title, releases=None, episodes=None):
+    releases = get_newest(releases or [])
+    episodes = get_newest(episodes or [])
+
+    # The cap applies to the whole feed, not to releases and episodes separately
+    kept = {id(item) for item in get_newest(releases + episodes)}
 
-    template = env.get_template('rss_feed.xml.j2')
-    render = template.render({
+    render = env.get_template('rss_feed.xml.j2').render({
         'api': api,
-        'releases': api.get_releases(),
-        'episodes': api.get_episodes(),
+        'title': title,
+        'feed_path': f'/{path}',
+        'releases': [item for item in releases if id(item) in kept],
+        'episodes': [item for item in episodes if id(item) in kept],
         'datetime': datetime
     })
 
-    rss_feed = open('static/feed', 'w')
-    rss_feed.write(render)
-    rss_feed.close()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Feed readers may fetch the file while it is written
+    with open(f'{path}.tmp', 'w') as rss_feed:
+        rss_feed.write(render)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def write_source_feed(path, title, releases=None, episodes=None):
+    # A source without entries left has no feed
+    if len(releases or []) + len(episodes or []) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    write_feed(path, title, releases=releases, episodes=episodes)
+
+
+def remove_source_feeds(type, ids):
+    for id in ids:
+        path = f'{FEEDS_PATH}/{type}/{id}'
+
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def remove_unfollowed_feeds(type, followed_ids):
+    if os.path.isdir(f'{FEEDS_PATH}/{type}'):
+        remove_source_feeds(type, [id for id in os.listdir(f'{FEEDS_PATH}/{type}') if id not in followed_ids])
+
+
+def get_latest(type):
+    db = api.get_databases().get(type)
+    return db.search_range(api.get_parameters().get('default_sorting'), float('-inf'), float('inf'),
+                           limit=api.get_parameters().get('rss_max_items'))
+
+
+def generate_feed(changed=None):
+    # changed holds the releases and episodes added or removed by a scan, None renders every feed
+    if changed is not None and len(changed.get('releases')) + len(changed.get('episodes')) == 0:
+        return
+
+    latest = {type: get_latest(type) for type in ['releases', 'episodes']}
+
+    write_feed(FEED_PATH, 'Spotify Tracker', releases=latest.get('releases'), episodes=latest.get('episodes'))
+
+    for type in ['releases', 'episodes']:
+        if changed is None or len(changed.get(type)) > 0:
+            write_feed(f'{FEEDS_PATH}/{type}', f'Spotify Tracker - {type}',
+                       releases=latest.get('releases') if type == 'releases' else None,
+                       episodes=latest.get('episodes') if type == 'episodes' else None)
+
+    changed_artists = None if changed is None else {artist_id for release in changed.get('releases')
+                                                    for artist_id in get_artist_ids(release)}
+    changed_shows = None if changed is None else {episode.get('show_id') for episode in changed.get('episodes')}
+
+    if changed_artists is None or len(changed_artists) > 0:
+        releases_by_artist = {}
+
+        for release in api.get_releases():
+            for artist_id in get_artist_ids(release):
+                releases_by_artist.setdefault(artist_id, []).append(release)
+
+        artists = api.get_artists()
+
+        # A full rendering also sweeps feeds whose artist is not followed anymore
+        if changed_artists is None:
+            remove_unfollowed_feeds('artists', {artist.get('id') for artist in artists})
+
+        for artist in artists:
+            if changed_artists is None or artist.get('id') in changed_artists:
+                write_source_feed(f'{FEEDS_PATH}/artists/{artist.get("id")}', f'Spotify Tracker - {artist.get("name")}',
+                                  releases=releases_by_artist.get(artist.get('id')))
+
+    if changed_shows is None or len(changed_shows) > 0:
+        episodes_by_show = {}
+
+        for episode in api.get_episodes():
+            episodes_by_show.setdefault(episode.get('show_id'), []).append(episode)
+
+        shows = api.get_shows()
+
+        if changed_shows is None:
+            remove_unfollowed_feeds('shows', {show.get('id') for show in shows})
+
+        for show in shows:
+            if changed_shows is None or show.get('id') in changed_shows:
+                write_source_feed(f'{FEEDS_PATH}/shows/{show.get("id")}',
+                                  f'Spotify Tracker - {show.get("show").get("name")}',
+                                  episodes=episodes_by_show.get(show.get('id')))
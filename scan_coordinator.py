@@ -0,0 +1,110 @@
+import logging
+import threading
+
+
+class ScanCoordinator:
+    def __init__(self, scan_function, cancel_function, reset_function):
+        self.__scan_function = scan_function
+        self.__cancel_function = cancel_function
+        self.__reset_function = reset_function
+        self.__lock = threading.Lock()
+        self.__running = None
+        self.__pending = None
+
+    def request_scan(self, type=None, due_only=False, artists=None, shows=None, followed_within=None):
+        request = {
+            'type': type,
+            'due_only': due_only,
+            'artists': None if artists is None else sorted(set(artists)),
+            'shows': None if shows is None else sorted(set(shows)),
+            'followed_within': followed_within
+        }
+
+        with self.__lock:
+            if self.__running is None:
+                self.__running = request
+                threading.Thread(target=self.__run, args=(request,), daemon=True).start()
+                return {'status': 'started', 'request': request}
+
+            if self.__covers(self.__running, request):
+                return {'status': 'merged', 'request': self.__running}
+
+            self.__pending = request if self.__pending is None else self.__merge(self.__pending, request)
+            return {'status': 'queued', 'request': self.__pending}
+
+    def cancel(self):
+        with self.__lock:
+            self.__pending = None
+
+            if self.__running is None:
+                return False
+
+            # Set under the lock, the flag cannot outlive the request it was meant for
+            return self.__cancel_function()
+
+    def get_running(self):
+        return self.__running
+
+    def get_pending(self):
+        return self.__pending
+
+    def __run(self, request):
+        while request is not None:
+            try:
+                self.__scan_function(**request)
+            except Exception as e:
+                logging.getLogger().exception(f'Scan failed - {e}')
+
+            with self.__lock:
+                # A cancellation applies to the whole request, even when it runs several scans
+                self.__reset_function()
+                request = self.__pending
+                self.__pending = None
+                self.__running = request
+
+    @staticmethod
+    def __has_selection(request):
+        return request.get('artists') is not None or request.get('shows') is not None or request.get(
+            'followed_within') is not None
+
+    @staticmethod
+    def __covers(scan, request):
+        if not ((scan.get('type') is None or scan.get('type') == request.get('type')) and (
+                not scan.get('due_only') or request.get('due_only'))):
+            return False
+
+        if not ScanCoordinator.__has_selection(scan):
+            return True
+
+        if not ScanCoordinator.__has_selection(request):
+            return False
+
+        return (set(request.get('artists') or []) <= set(scan.get('artists') or []) and
+                set(request.get('shows') or []) <= set(scan.get('shows') or []) and
+                ScanCoordinator.__get_followed_within(request) <= ScanCoordinator.__get_followed_within(scan))
+
+    @staticmethod
+    def __get_followed_within(request):
+        return -1 if request.get('followed_within') is None else request.get('followed_within')
+
+    @staticmethod
+    def __merge(first, second):
+        merged = {
+            'type': first.get('type') if first.get('type') == second.get('type') else None,
+            'due_only': first.get('due_only') and second.get('due_only'),
+            'artists': None,
+            'shows': None,
+            'followed_within': None
+        }
+
+        # Selections are unions (ids or recently followed), merging them simply widens them
+        if ScanCoordinator.__has_selection(first) and ScanCoordinator.__has_selection(second):
+            for key in ['artists', 'shows']:
+                if first.get(key) is not None or second.get(key) is not None:
+                    merged[key] = sorted(set(first.get(key) or []) | set(second.get(key) or []))
+
+            followed_within = max(ScanCoordinator.__get_followed_within(first),
+                                  ScanCoordinator.__get_followed_within(second))
+            merged['followed_within'] = None if followed_within == -1 else followed_within
+
+        return merged
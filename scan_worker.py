@@ -0,0 +1,119 @@
+import socket
+import threading
+from multiprocessing.connection import Connection, Listener, AuthenticationError, answer_challenge, deliver_challenge
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+import spotify_api_helpers as api
+
+params = api.get_parameters()
+logging = params.get_logger()
+
+
+def get_address():
+    return 'localhost', params.get('scan_worker_port')
+
+
+def get_authkey():
+    return params.get('client_secret').encode()
+
+
+def wait_for(connection):
+    if not connection.poll(params.get('scan_worker_timeout')):
+        raise TimeoutError(f'no answer within {params.get("scan_worker_timeout")} seconds')
+
+
+def connect():
+    # Client has no timeout, a worker that stopped accepting would block the connection and the handshake forever
+    with socket.create_connection(get_address(), timeout=params.get('scan_worker_timeout')) as client_socket:
+        client_socket.settimeout(None)
+        return Connection(client_socket.detach())
+
+
+def send_command(command, **kwargs):
+    with connect() as connection:
+        wait_for(connection)
+        answer_challenge(connection, get_authkey())
+        deliver_challenge(connection, get_authkey())
+
+        connection.send({'command': command, 'kwargs': kwargs})
+        wait_for(connection)
+        reply = connection.recv()
+
+    if reply.get('error') is not None:
+        logging.error(f'Scan worker : {command} failed - {reply.get("error")}')
+
+    return reply.get('result')
+
+
+commands = {
+    'start': api.get_scan_coordinator().request_scan,
+    'status': api.get_analysis_status,
+    'cancel': api.get_scan_coordinator().cancel,
+    'metrics': api.get_metrics().snapshot
+}
+
+
+def start_scheduler():
+    scheduler = BackgroundScheduler()
+    trigger = CronTrigger.from_crontab(params.get('cron'))
+    scheduler.add_job(api.get_scan_coordinator().request_scan, trigger,
+                      kwargs={'due_only': params.get('adaptive_scheduling')})
+    scheduler.start()
+
+    # A scan interrupted by a crash or a restart goes on where it stopped
+    if api.get_scan_checkpoint() is not None:
+        api.get_scan_coordinator().request_scan(due_only=params.get('adaptive_scheduling'))
+
+    return scheduler
+
+
+def handle(connection):
+    with connection:
+        try:
+            deliver_challenge(connection, get_authkey())
+            answer_challenge(connection, get_authkey())
+
+            wait_for(connection)
+            message = connection.recv()
+        except (AuthenticationError, EOFError, OSError) as e:
+            logging.warning(f'Scan worker : invalid request - {e}')
+            return
+
+        try:
+            command = commands.get(message.get('command'))
+
+            if command is None:
+                reply = {'error': f'Unknown command {message.get("command")}'}
+            else:
+                reply = {'result': command(**(message.get('kwargs') or {}))}
+        except Exception as e:
+            logging.exception(f'Scan worker : {message} failed - {e}')
+            reply = {'error': str(e)}
+
+        try:
+            connection.send(reply)
+        except (EOFError, OSError) as e:
+            logging.warning(f'Scan worker : cannot answer - {e}')
+
+
+def serve():
+    start_scheduler()
+
+    # The handshake happens in each connection thread, a stuck peer only blocks its own thread
+    with Listener(get_address(), backlog=16) as listener:
+        logging.info(f'Scan worker listening on {get_address()}')
+
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError as e:
+                logging.warning(f'Scan worker : cannot accept a connection - {e}')
+                continue
+
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    serve()
@@ -1,38 +1,68 @@
-import asyncio
 import base64
 import datetime
+import json
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 
 import requests
 from requests import Request
-from tinydb import TinyDB, Query
+from requests.adapters import HTTPAdapter
 
+import enrichment
+import ingest_schema
+import page_renderer
 import params_utils
 import rss_feed_generator
+import storage
+from metrics import Metrics, InstrumentedTable, get_endpoint, get_total
+from rate_limiter import RateLimiter, parse_retry_after
+from scan_coordinator import ScanCoordinator
 from ws_manager import ConnectionManager
 
-db_root_users = TinyDB('data/database_users.json')
-db_users = db_root_users.table('users', cache_size=0)
-db_root_artists = TinyDB('data/database_artists.json')
-db_artists = db_root_artists.table('artists', cache_size=0)
-db_root_releases = TinyDB('data/database_releases.json')
-db_releases = db_root_releases.table('releases', cache_size=0)
-db_root_metadata = TinyDB('data/database_metadata.json')
-db_metadata = db_root_metadata.table('metadata', cache_size=0)
-db_root_shows = TinyDB('data/database_shows.json')
-db_shows = db_root_shows.table('shows', cache_size=0)
-db_root_episodes = TinyDB('data/database_episodes.json')
-db_episodes = db_root_episodes.table('episodes', cache_size=0)
-
 params = params_utils.ConfigManager()
 client_id = params.get('client_id')
 client_secret = params.get('client_secret')
+api_url = params.get('spotify_api_url')
+accounts_url = params.get('spotify_accounts_url')
 authorization = f'Basic {base64.b64encode((f"{client_id}:{client_secret}").encode("ascii")).decode("ascii")}'
 
 logging = params.get_logger()
-ws_manager = ConnectionManager()
+
+metrics = Metrics(enabled=params.get('metrics'))
+databases = storage.open_tables(params.get('storage_backend'))
+
+if metrics.enabled:
+    databases = {name: InstrumentedTable(table, metrics) for name, table in databases.items()}
+
+db_users = databases.get('users')
+db_artists = databases.get('artists')
+db_releases = databases.get('releases')
+db_metadata = databases.get('metadata')
+db_shows = databases.get('shows')
+db_episodes = databases.get('episodes')
+db_scan_state = databases.get('scan_state')
+db_scan_history = databases.get('scan_history')
+db_scan_checkpoints = databases.get('scan_checkpoints')
+ws_manager = ConnectionManager(max_rate=params.get('ws_max_rate'), send_timeout=params.get('ws_send_timeout'))
+rate_limiter = RateLimiter(max_rate=params.get('rate_limit'))
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=params.get('http_pool_size')))
+session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=params.get('http_pool_size')))
+
+# The token is refreshed this many seconds before its real expiration
+TOKEN_EXPIRATION_MARGIN = 60
+
+# With adaptive scheduling, an artist releasing once a day is checked every hour
+CHECKS_PER_RELEASE = 24
+
+SCAN_HISTORY_SIZE = 100
+
+cached_user_token = None
+token_lock = threading.RLock()
 
 
 def get_authorization_code_url():
@@ -47,16 +77,25 @@ def get_authorization_code_url():
         'state': state
     }
 
-    return Request(url='https://accounts.spotify.com/authorize?', params=request_params).prepare().url
+    return Request(url=f'{accounts_url}/authorize?', params=request_params).prepare().url
 
 
-def get_user_stored_token(refresh=True):
+def load_user_token():
+    global cached_user_token
+
     try:
-        found = db_users.all()[0]
+        cached_user_token = db_users.all()[0]
     except:
-        logging.error(
-            f'Unable to retrieve user in database, please connect your spotify account here : {params.get("application_url")}/login')
-        return None
+        cached_user_token = None
+
+    return cached_user_token
+
+
+def get_user_stored_token(refresh=True):
+    found = cached_user_token
+
+    if found is None:
+        found = load_user_token()
 
     if found is None:
         logging.error(
@@ -65,31 +104,35 @@ def get_user_stored_token(refresh=True):
     else:
         current_date = datetime.datetime.now()
 
-        if found.get('expires_on') < current_date.timestamp() and refresh is True:
+        if found.get('expires_on') - TOKEN_EXPIRATION_MARGIN < current_date.timestamp() and refresh is True:
             logging.info(
-                f'Stored user access_token expired on {datetime.datetime.fromtimestamp(found.get("expires_on"))}, requesting a new one')
-            refresh_access_token()
-            return get_user_stored_token()
+                f'Stored user access_token expires on {datetime.datetime.fromtimestamp(found.get("expires_on"))}, requesting a new one')
+            refresh_access_token(expired_token=found)
+            return get_user_stored_token(refresh=False)
 
         return found
 
 
 def request_access_token(code):
-    auth_query = requests.post(url='https://accounts.spotify.com/api/token',
-                               headers={
-                                   'Content-Type': 'application/x-www-form-urlencoded',
-                                   'Authorization': authorization
-                               },
-                               data={
-                                   'code': code,
-                                   'redirect_uri': f'{params.get("application_url")}/auth',
-                                   'grant_type': 'authorization_code'
-                               }
-                               )
+    global cached_user_token
+
+    rate_limiter.acquire()
+    auth_query = session.post(url=f'{accounts_url}/api/token',
+                              timeout=params.get('http_timeout'),
+                              headers={
+                                  'Content-Type': 'application/x-www-form-urlencoded',
+                                  'Authorization': authorization
+                              },
+                              data={
+                                  'code': code,
+                                  'redirect_uri': f'{params.get("application_url")}/auth',
+                                  'grant_type': 'authorization_code'
+                              }
+                              )
 
     if auth_query.status_code == 200:
         current_date = datetime.datetime.now()
-        db_root_users.drop_table('users')
+        db_users.truncate()
 
         user_object = auth_query.json()
         expires_on = current_date + timedelta(seconds=user_object.get('expires_in'))
@@ -98,7 +141,13 @@ def request_access_token(code):
         logging.info(f'New token expires on {expires_on}')
         db_users.insert(user_object)
 
+        with token_lock:
+            cached_user_token = user_object
+
     elif auth_query.status_code in [400, 429]:
+        if auth_query.status_code == 429:
+            rate_limiter.throttled(parse_retry_after(auth_query.headers.get('Retry-After')))
+
         raise PermissionError(f'{auth_query.status_code} - {auth_query.text}')
     else:
         logging.error(f'access_token request query failed - {auth_query.status_code} - {auth_query.text}')
@@ -106,34 +155,50 @@ def request_access_token(code):
     return auth_query
 
 
-def refresh_access_token():
-    stored_user_token = get_user_stored_token(refresh=False)
+def refresh_access_token(expired_token=None):
+    global cached_user_token
 
-    refresh_query = requests.post(url='https://accounts.spotify.com/api/token',
-                                  headers={
-                                      'Content-Type': 'application/x-www-form-urlencoded',
-                                      'Authorization': authorization
-                                  },
-                                  data={
-                                      'grant_type': 'refresh_token',
-                                      'refresh_token': stored_user_token.get('refresh_token')
-                                  }
-                                  )
+    with token_lock:
+        # Another worker (or process) may have refreshed the token while this one was waiting for the lock
+        stored_user_token = load_user_token()
 
-    if refresh_query.status_code == 200:
-        current_date = datetime.datetime.now()
+        if stored_user_token is None:
+            return None
 
-        user_object = refresh_query.json()
-        expires_on = current_date + timedelta(seconds=user_object.get('expires_in'))
-        user_object['expires_on'] = expires_on.timestamp()
+        if expired_token is not None and stored_user_token.get('access_token') != expired_token.get('access_token'):
+            return None
 
-        logging.info(f'New token expires on {expires_on}')
-        db_users.update(user_object, doc_ids=[1])
+        rate_limiter.acquire()
+        refresh_query = session.post(url=f'{accounts_url}/api/token',
+                                     timeout=params.get('http_timeout'),
+                                     headers={
+                                         'Content-Type': 'application/x-www-form-urlencoded',
+                                         'Authorization': authorization
+                                     },
+                                     data={
+                                         'grant_type': 'refresh_token',
+                                         'refresh_token': stored_user_token.get('refresh_token')
+                                     }
+                                     )
 
-    elif refresh_query.status_code in [400, 429]:
-        raise PermissionError(f'{refresh_query.status_code} - {refresh_query.text}')
-    else:
-        logging.error(f'access_token refresh query failed - {refresh_query.status_code} - {refresh_query.text}')
+        if refresh_query.status_code == 200:
+            current_date = datetime.datetime.now()
+
+            user_object = refresh_query.json()
+            expires_on = current_date + timedelta(seconds=user_object.get('expires_in'))
+            user_object['expires_on'] = expires_on.timestamp()
+
+            logging.info(f'New token expires on {expires_on}')
+            db_users.update(user_object)
+            cached_user_token = stored_user_token | user_object
+
+        elif refresh_query.status_code in [400, 429]:
+            if refresh_query.status_code == 429:
+                rate_limiter.throttled(parse_retry_after(refresh_query.headers.get('Retry-After')))
+
+            raise PermissionError(f'{refresh_query.status_code} - {refresh_query.text}')
+        else:
+            logging.error(f'access_token refresh query failed - {refresh_query.status_code} - {refresh_query.text}')
 
     return refresh_query
 
@@ -142,35 +207,37 @@ def shows_api_call_handler(request):
     response = request.json()
     new_items = response.get('items')
 
-    for item in new_items:
-        del item.get('show')['available_markets']
+    for index, item in enumerate(new_items):
+        item['id'] = item.get('show').get('id')
+        new_items[index] = ingest_schema.project('shows', item)
 
     return response, new_items
 
 
-def get_from_api(type, next_url=None, items_retrieved=[], retry_count=0, item=None):
-    stored_user_token = get_user_stored_token()
+def get_releases_url(artist, group):
+    return (f'{api_url}/artists/{artist.get("id")}/albums?include_groups={group}'
+            f'&limit={params.get("albums_request_limit")}')
 
-    if stored_user_token is None:
-        return None
 
-    db_root, db = get_databases().get(type)
+def iterate_pages(type, item=None, errors=None):
+    if errors is None:
+        errors = []
+
+    if get_user_stored_token() is None:
+        errors.append('no user')
+        return
 
     config = {
         'artists': {
-            'url': lambda x: [('artists', 'https://api.spotify.com/v1/me/following?type=artist&limit=50')],
+            'url': lambda x: [('artists', f'{api_url}/me/following?type=artist&limit=50')],
             'success_callback': lambda x: (x.json().get('artists'), x.json().get('artists').get('items')),
-            'drop': True,
-            'save_method': db.insert_multiple,
             'running_log': lambda n, g, i=None, t=None: f'{len(n)}/{t} {type} added to the list',
             'error_log': lambda i, r: f'Error while fetching {type} - {r.status_code} - {r.text}',
             'must_continue': lambda i: True
         },
         'shows': {
-            'url': lambda x: [('shows', 'https://api.spotify.com/v1/me/shows?limit=50')],
+            'url': lambda x: [('shows', f'{api_url}/me/shows?limit=50')],
             'success_callback': shows_api_call_handler,
-            'drop': True,
-            'save_method': db.insert_multiple,
             'running_log': lambda n, g, i=None, t=None: f'{len(n)}/{t} {type} added to the list',
             'error_log': lambda i, r: f'Error while fetching {type} - {r.status_code} - {r.text}',
             'must_continue': lambda i: True
@@ -178,10 +245,8 @@ def get_from_api(type, next_url=None, items_retrieved=[], retry_count=0, item=No
         'episodes': {
             'url': lambda x: [
                 ('episode',
-                 f'https://api.spotify.com/v1/shows/{x.get("show").get("id")}/episodes?limit={params.get("albums_request_limit")}')],
+                 f'{api_url}/shows/{x.get("show").get("id")}/episodes?limit={params.get("albums_request_limit")}')],
             'success_callback': lambda x: (x.json(), x.json().get('items')),
-            'drop': False,
-            'save_method': None,
             'running_log': lambda n, i, g,
                                   t=None: f'{i.get("show").get("name")} ({i.get("show").get("id")}) : {len(n)}/{t} {type} added to the list',
             'error_log': lambda i,
@@ -190,13 +255,8 @@ def get_from_api(type, next_url=None, items_retrieved=[], retry_count=0, item=No
                 days=params.get('newer_than'))
         },
         'releases': {
-            'url': lambda x: [
-                (group,
-                 f'https://api.spotify.com/v1/artists/{x.get("id")}/albums?include_groups={group}&limit={params.get("albums_request_limit")}')
-                for group in params.get("include_groups")],
+            'url': lambda x: [(group, get_releases_url(x, group)) for group in params.get("include_groups")],
             'success_callback': lambda x: (x.json(), x.json().get('items')),
-            'drop': False,
-            'save_method': None,
             'running_log': lambda n, i, g,
                                   t=None: f'{i.get("name")} ({i.get("id")}) : {len(n)}/{t} {type} ({g}) added to the list',
             'error_log': lambda i,
@@ -207,56 +267,85 @@ def get_from_api(type, next_url=None, items_retrieved=[], retry_count=0, item=No
         }
     }
 
-    if next_url is None:
-        urls = config.get(type).get('url')(item)
-    else:
-        urls = [(type, next_url)]
+    for subgroup, url in config.get(type).get('url')(item):
+        while url is not None:
+            request = request_api(url)
 
-    for subgroup, url in urls:
-        request = requests.get(url=url, headers={
-            'Authorization': f'Bearer {stored_user_token.get("access_token")}'
-        })
+            if request is None:
+                logging.error(f'Error while fetching {type} - giving up on {url}')
+                errors.append(url)
+                break
+            elif request.status_code != 200:
+                logging.error(config.get(type).get('error_log')(i=item, r=request))
+                errors.append(url)
+                break
 
-        if request.status_code == 200:
             response, new_items = config.get(type).get('success_callback')(request)
+            metrics.inc('spotify_pages_total', type=type)
 
-            items_retrieved = items_retrieved + new_items
+            logging.info(config.get(type).get('running_log')(n=new_items, i=item, t=response.get('total'),
+                                                             g=subgroup))
+
+            yield subgroup, response, new_items
 
             try:
                 last_item = new_items[-1]
             except IndexError:
                 last_item = None
 
-            logging.info(config.get(type).get('running_log')(n=new_items, i=item, t=response.get('total'),
-                                                             g=subgroup))
-
             if response.get('next') is not None and config.get(type).get('must_continue')(last_item):
-                items, items_retrieved = get_from_api(type=type, next_url=response.get('next'),
-                                               items_retrieved=items_retrieved, item=item)
+                url = response.get('next')
             else:
-                pass
-                if config.get(type).get('drop'):
-                    db_root.drop_table(type)
-
-                if config.get(type).get('save_method') is not None:
-                    config.get(type).get('save_method')(items_retrieved)
-
-        elif request.status_code == 401 and retry_count < 3:
-            refresh_access_token()
-            item, items_retrieved = get_from_api(type=type, next_url=url, items_retrieved=items_retrieved,
-                                                 retry_count=retry_count + 1,
-                                                 item=item)
-        elif request.status_code == 429 and retry_count < 3:
-            time.sleep(5)
-            item, items_retrieved = get_from_api(type=type, next_url=url, items_retrieved=items_retrieved,
-                                                 retry_count=retry_count + 1,
-                                                 item=item)
-        else:
-            logging.error(config.get(type).get('error_log')(i=item, r=request))
+                url = None
+
+
+def get_from_api(type, item=None, errors=None):
+    if get_user_stored_token() is None:
+        return None
+
+    items_retrieved = []
+
+    for subgroup, response, new_items in iterate_pages(type=type, item=item, errors=errors):
+        items_retrieved.extend(new_items)
 
     return item, items_retrieved
 
 
+def request_api(url, retry_count=0):
+    stored_user_token = get_user_stored_token()
+
+    if stored_user_token is None:
+        return None
+
+    endpoint = get_endpoint(url) if metrics.enabled else None
+
+    rate_limiter.acquire()
+    try:
+        with metrics.timer('spotify_request_duration_seconds', endpoint=endpoint):
+            request = session.get(url=url, timeout=params.get('http_timeout'), headers={
+                'Authorization': f'Bearer {stored_user_token.get("access_token")}'
+            })
+    except requests.exceptions.RequestException as e:
+        logging.warning(f'Request to {url} failed - {e}')
+        request = None
+
+    metrics.inc('spotify_requests_total', endpoint=endpoint, status='error' if request is None else request.status_code)
+
+    if request is None:
+        if retry_count < 3:
+            return request_api(url, retry_count=retry_count + 1)
+    elif request.status_code == 401 and retry_count < 3:
+        refresh_access_token(expired_token=stored_user_token)
+        return request_api(url, retry_count=retry_count + 1)
+    elif request.status_code == 429 and retry_count < 3:
+        retry_after = parse_retry_after(request.headers.get('Retry-After'))
+        logging.warning(f'Too many requests, waiting {retry_after} seconds before retrying')
+        rate_limiter.throttled(retry_after)
+        return request_api(url, retry_count=retry_count + 1)
+
+    return request
+
+
 def get_release_date_object(item):
     date_format = {
         'day': '%Y-%m-%d',
@@ -273,8 +362,10 @@ def save_releases_to_database(items, type):
     newer_than_date = current_date - timedelta(days=params.get('newer_than'))
 
     items_to_add = []
+    new_items = []
 
-    db_root, db = get_databases().get(type)
+    db = get_databases().get(type)
+    known_ids = db.get_ids()
 
     for item_category_tuple in items:
         element, item_category = item_category_tuple
@@ -282,65 +373,420 @@ def save_releases_to_database(items, type):
         for item in [i for i in item_category if i is not None]:
             release_date = get_release_date_object(item)
 
-            if release_date > newer_than_date:
-                item['release_date_timestamp'] = release_date.timestamp()
-                item['added_date_timestamp'] = current_date.timestamp()
+            # The same release can be returned for several artists or groups within a single scan
+            if release_date > newer_than_date and item.get('id') not in known_ids:
+                known_ids.add(item.get('id'))
+                new_items.append((element, item, release_date))
+
+    # Archived before the enrichment and the projection change the documents
+    ingest_schema.archive(type, [item for element, item, release_date in new_items])
 
-                try:
-                    del item['available_markets']
-                except KeyError:
-                    pass
+    # Details of every new entry are requested at once, through the multi-id endpoints
+    enrichment.enrich(type, [item for element, item, release_date in new_items])
 
-                q = Query()
+    for element, item, release_date in new_items:
+        item = ingest_schema.project(type, item)
+        item['release_date_timestamp'] = release_date.timestamp()
+        item['added_date_timestamp'] = current_date.timestamp()
+        item['artist_id' if type == 'releases' else 'show_id'] = element.get('id')
+
+        if type == 'releases':
+            logging.info(
+                f'{type} : {element.get("name")} ({element.get("id")}) : {item.get("release_date")} - {item.get("total_tracks")} tracks - ({item.get("id")}) {item.get("name")}')
+        elif type == 'episodes':
+            logging.info(
+                f'{type} : {element.get("show").get("name")} ({element.get("show").get("id")}) : {item.get("release_date")} - {item.get("duration_ms")} ms - ({item.get("id")}) {item.get("name")}')
 
-                if not db.search(q.id == item.get('id')):
-                    if type == 'releases':
-                        logging.info(
-                            f'{type} : {element.get("name")} ({element.get("id")}) : {item.get("release_date")} - {item.get("total_tracks")} tracks - ({item.get("id")}) {item.get("name")}')
-                    elif type == 'episodes':
-                        logging.info(
-                            f'{type} : {element.get("show").get("name")} ({element.get("show").get("id")}) : {item.get("release_date")} - {item.get("duration_ms")} ms - ({item.get("id")}) {item.get("name")}')
-                    items_to_add.append(item)
+        items_to_add.append(item)
 
     inserted = db.insert_multiple(items_to_add)
 
     logging.info(f'{type} : {len(inserted)} new entries')
 
+    return items_to_add
+
 
 def remove_outdated_releases_from_db():
     current_date = datetime.datetime.now()
     newer_than_date = current_date - timedelta(days=params.get('newer_than'))
-    q = Query()
 
-    removed_albums = db_releases.remove(q.release_date_timestamp < newer_than_date.timestamp())
-    removed_episodes = db_episodes.remove(q.release_date_timestamp < newer_than_date.timestamp())
+    # Removed entries are returned so that the feeds they belonged to are refreshed
+    removed = {type: get_databases().get(type).search_range('release_date_timestamp', float('-inf'),
+                                                             newer_than_date.timestamp())
+               for type in ['releases', 'episodes']}
+
+    removed_albums = db_releases.remove_older_than('release_date_timestamp', newer_than_date.timestamp())
+    removed_episodes = db_episodes.remove_older_than('release_date_timestamp', newer_than_date.timestamp())
 
-    logging.info(f'Entries removed : {len(removed_albums)} albums, {len(removed_episodes)} episodes')
+    logging.info(f'Entries removed : {removed_albums} albums, {removed_episodes} episodes')
+
+    return removed
 
 
 current_analysis_status = None
+scan_cancelled = threading.Event()
 
 
 def get_analysis_status():
     return current_analysis_status
 
 
-def perform_full_search(type=None):
-    get_from_api(type='artists')
-    get_from_api(type='shows')
+def cancel_search():
+    logging.warning('Scan cancellation requested, artists and shows already scanned will be saved')
+    scan_cancelled.set()
+
+    return True
+
+
+def reset_cancellation():
+    scan_cancelled.clear()
+
+
+follows_diff = {'artists': None, 'shows': None}
+
+
+def get_followed_date(item):
+    if item.get('added_at') is not None:
+        return datetime.datetime.strptime(item.get('added_at'), '%Y-%m-%dT%H:%M:%SZ').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    return datetime.datetime.now().timestamp()
+
+
+# Fields compared to detect a changed follow, follower counts and popularity of artists change daily
+FINGERPRINT_FIELDS = {
+    'artists': ['id', 'name', 'images', 'external_urls']
+}
+
+
+def get_fingerprint(type, item):
+    fields = FINGERPRINT_FIELDS.get(type)
+
+    return hash(json.dumps({key: value for key, value in item.items()
+                            if key != 'followed_date_timestamp' and (fields is None or key in fields)},
+                           sort_keys=True))
+
+
+def sync_followed(type):
+    db = get_databases().get(type)
+
+    # Only a fingerprint of each stored entry is kept, with the follow date that must survive an update
+    stored = {document.get('id'): (get_fingerprint(type, document), document.get('followed_date_timestamp'))
+              for document in db.iterate()}
+
+    if None in stored:
+        logging.info(f'{type} : stored entries have no id, the whole list is replaced')
+        db.truncate()
+        stored = {}
+
+    errors = []
+    followed_ids = set()
+    added = []
+    updated = []
+
+    # Added and changed follows are written once the whole list is retrieved
+    for subgroup, response, page in iterate_pages(type=type, errors=errors):
+        for item in page:
+            if item.get('id') in followed_ids:
+                continue
+
+            if item.get('id') not in stored:
+                item['followed_date_timestamp'] = get_followed_date(item)
+                added.append(item)
+            elif get_fingerprint(type, item) != stored.get(item.get('id'))[0]:
+                # Names or images changed since the entry was stored
+                # Entries stored before follow dates were recorded have none
+                item['followed_date_timestamp'] = stored.get(item.get('id'))[1] or get_followed_date(item)
+                updated.append(item)
+
+            followed_ids.add(item.get('id'))
+
+    if len(added) > 0:
+        db.insert_multiple(added)
+
+    if len(updated) > 0:
+        db.upsert_multiple(updated)
+
+    if len(errors) > 0:
+        logging.error(f'{type} : the list could not be fully retrieved, unfollowed {type} are kept for now')
+        return None
+
+    removed = [id for id in stored if id not in followed_ids]
+
+    db.remove_ids(removed)
+    db_scan_state.remove_ids(removed)
+    rss_feed_generator.remove_source_feeds(type, removed)
+
+    follows_diff[type] = {
+        'added': added,
+        'updated': [item.get('id') for item in updated],
+        'removed': removed,
+        'unchanged': len(followed_ids) - len(added) - len(updated)
+    }
+
+    logging.info(f'{type} : {len(added)} added, {len(updated)} updated, {len(removed)} removed, '
+                 f'{follows_diff[type].get("unchanged")} unchanged')
+
+    return follows_diff[type]
+
+
+def get_follows_diff():
+    return follows_diff
+
+
+def get_new_follows_first(items, type):
+    diff = follows_diff.get(type)
+
+    if diff is None:
+        return items
+
+    added_ids = {item.get('id') for item in diff.get('added')}
+
+    return [item for item in items if item.get('id') in added_ids] + [item for item in items if
+                                                                      item.get('id') not in added_ids]
+
+
+def perform_full_search(type=None, due_only=False):
+    follows_diff['artists'] = None
+    follows_diff['shows'] = None
+
+    diffs = [sync_followed(type='artists'), sync_followed(type='shows')]
+
+    # The artists and shows pages changed, even if the scan is cancelled before its end
+    if any(diff is not None and len(diff.get('added')) + len(diff.get('updated')) + len(diff.get('removed')) > 0
+           for diff in diffs):
+        update_metadata()
+
+    if scan_cancelled.is_set():
+        logging.warning('Scan cancelled before analysing artists and shows')
+        return
+
+    artists = get_artists()
+    shows = get_shows()
+
+    if due_only:
+        artists = get_due_items(artists)
+        shows = get_due_items(shows)
+        logging.info(f'{len(artists)} artists and {len(shows)} shows are due for a new check')
 
-    perform_search(type=type)
+    # Newly followed artists and shows are scanned first
+    perform_search(artists=get_new_follows_first(artists, 'artists'),
+                   shows=get_new_follows_first(shows, 'shows'), type=type)
 
 
-def perform_search(artists=None, shows=None, type=None):
-    loop = asyncio.new_event_loop()
+def get_artist_scan_state(artist):
+    groups = ','.join(params.get('include_groups'))
+    request = request_api(f'{api_url}/artists/{artist.get("id")}/albums?include_groups={groups}&limit=1')
 
+    if request is None or request.status_code != 200:
+        return None
+
+    response = request.json()
+    first_release = next((item for item in response.get('items') if item is not None), {})
+
+    # Spotify lists the groups one after the other, the first release is the newest of the first group only.
+    # A release added to any other group still changes the total
+    return {
+        'id': artist.get('id'),
+        'groups': groups,
+        'total': response.get('total'),
+        'first_release_id': first_release.get('id'),
+        'last_scan_timestamp': datetime.datetime.now().timestamp()
+    }
+
+
+def is_scan_state_unchanged(previous_state, new_state):
+    if previous_state is None or new_state is None:
+        return False
+
+    return all(previous_state.get(key) == new_state.get(key) for key in ['groups', 'total', 'first_release_id'])
+
+
+def get_release_gap_days(items):
+    release_dates = sorted({get_release_date_object(item) for item in items if item is not None}, reverse=True)
+
+    if len(release_dates) < 2:
+        return None
+
+    return (release_dates[0] - release_dates[-1]).days / (len(release_dates) - 1)
+
+
+def schedule_next_check(scan_state):
+    current_date = datetime.datetime.now()
+    gap_days = scan_state.get('release_gap_days')
+
+    if scan_state.get('newest_release_timestamp') is not None:
+        days_since_newest = (current_date.timestamp() - scan_state.get('newest_release_timestamp')) / 86400
+        gap_days = days_since_newest if gap_days is None else max(gap_days, days_since_newest)
+
+    if gap_days is None:
+        interval = params.get('schedule_max_interval')
+    else:
+        interval = min(params.get('schedule_max_interval'),
+                       max(params.get('schedule_min_interval'), gap_days * 24 / CHECKS_PER_RELEASE))
+
+    scan_state['next_check_timestamp'] = (current_date + timedelta(hours=interval)).timestamp()
+
+    return scan_state
+
+
+def scan_item(type, item, previous_state=None):
+    if scan_cancelled.is_set():
+        return (item, []), None
+
+    # A single request over all groups tells if anything changed for this artist since the previous scan,
+    # the listings of every group are only requested when it did
+    if type == 'releases':
+        scan_state = get_artist_scan_state(item)
+
+        if is_scan_state_unchanged(previous_state, scan_state):
+            logging.info(f'{item.get("name")} ({item.get("id")}) : nothing changed since last scan')
+            time.sleep(params.get('delay'))
+
+            scan_state['release_gap_days'] = previous_state.get('release_gap_days')
+            scan_state['newest_release_timestamp'] = previous_state.get('newest_release_timestamp')
+
+            return (item, []), schedule_next_check(scan_state)
+    else:
+        scan_state = {
+            'id': item.get('id'),
+            'last_scan_timestamp': datetime.datetime.now().timestamp()
+        }
+
+    errors = []
+    result = get_from_api(type=type, item=item, errors=errors)
+    time.sleep(params.get('delay'))
+
+    if scan_state is None or result is None or len(errors) > 0:
+        return result, None
+
+    items = [i for i in result[1] if i is not None]
+
+    scan_state['release_gap_days'] = get_release_gap_days(items)
+    scan_state['newest_release_timestamp'] = max(
+        [get_release_date_object(i).timestamp() for i in items], default=None)
+
+    return result, schedule_next_check(scan_state)
+
+
+def get_due_items(items):
+    current_timestamp = datetime.datetime.now().timestamp()
+    scan_states = {state.get('id'): state for state in db_scan_state.all()}
+
+    return [item for item in items if
+            scan_states.get(item.get('id'), {}).get('next_check_timestamp', 0) <= current_timestamp]
+
+
+def get_selected_items(items, ids, followed_within):
+    ids = set(ids or [])
+    followed_since = None
+
+    if followed_within is not None:
+        followed_since = (datetime.datetime.now() - timedelta(days=followed_within)).timestamp()
+
+    return [item for item in items if item.get('id') in ids or (
+            followed_since is not None and (item.get('followed_date_timestamp') or 0) >= followed_since)]
+
+
+def perform_partial_search(type=None, artists=None, shows=None, followed_within=None):
+    selected_artists = get_selected_items(get_artists(), artists, followed_within)
+    selected_shows = get_selected_items(get_shows(), shows, followed_within)
+
+    unknown_ids = (set(artists or []) - {artist.get('id') for artist in selected_artists}) | (
+            set(shows or []) - {show.get('id') for show in selected_shows})
+
+    if len(unknown_ids) > 0:
+        logging.warning(f'Not followed (or not synchronized yet), ignored : {sorted(unknown_ids)}')
+
+    logging.info(f'Partial scan : {len(selected_artists)} artists and {len(selected_shows)} shows')
+
+    perform_search(artists=selected_artists, shows=selected_shows, type=type, partial=True)
+
+
+def get_scan_checkpoint():
+    checkpoints = db_scan_checkpoints.all()
+    return checkpoints[0] if len(checkpoints) > 0 else None
+
+
+def save_scan_checkpoint(checkpoint):
+    db_scan_checkpoints.truncate()
+
+    if checkpoint is not None:
+        db_scan_checkpoints.insert(checkpoint)
+
+
+def is_covered_by_checkpoint(checkpoint, type):
+    if checkpoint.get('type') not in [None, type]:
+        return False
+
+    return ((type == 'episodes' or {artist.get('id') for artist in get_artists()} <= set(checkpoint.get('artists')))
+            and (type == 'releases' or {show.get('id') for show in get_shows()} <= set(checkpoint.get('shows'))))
+
+
+def resume_interrupted_search(checkpoint):
+    remaining = {}
+
+    for key, items in [('artists', get_artists()), ('shows', get_shows())]:
+        items_by_id = {item.get('id'): item for item in items}
+        done = set(checkpoint.get(f'done_{key}'))
+
+        # The original order is kept, new follows were first
+        remaining[key] = [items_by_id.get(id) for id in checkpoint.get(key) if id not in done and id in items_by_id]
+
+    logging.warning(f'Resuming interrupted scan {checkpoint.get("id")} : {len(remaining.get("artists"))} artists '
+                    f'and {len(remaining.get("shows"))} shows left')
+
+    perform_search(artists=remaining.get('artists'), shows=remaining.get('shows'), type=checkpoint.get('type'),
+                   checkpoint=checkpoint)
+
+
+def perform_requested_search(type=None, due_only=False, artists=None, shows=None, followed_within=None):
+    checkpoint = get_scan_checkpoint()
+    is_full_search = artists is None and shows is None and followed_within is None
+
+    if checkpoint is not None:
+        resume_interrupted_search(checkpoint)
+
+        if scan_cancelled.is_set():
+            logging.warning('Scan cancelled while resuming the interrupted scan')
+            return
+
+        # The interrupted scan already went through everything a full scan would
+        if is_full_search and is_covered_by_checkpoint(checkpoint, type):
+            return
+
+    if is_full_search:
+        perform_full_search(type=type, due_only=due_only)
+    else:
+        perform_partial_search(type=type, artists=artists, shows=shows, followed_within=followed_within)
+
+
+def save_scan_batch(checkpoint, results, scan_states, added):
+    for type in ['releases', 'episodes']:
+        if len(results.get(type)) > 0:
+            with metrics.timer('ingest_duration_seconds', type=type):
+                added[type] += save_releases_to_database(items=results.get(type), type=type)
+
+            results[type] = []
+
+    # Saved after the releases so an artist is never marked as scanned before its releases are stored
+    db_scan_state.upsert_multiple(scan_states)
+    scan_states.clear()
+
+    checkpoint['updated_timestamp'] = datetime.datetime.now().timestamp()
+    save_scan_checkpoint(checkpoint)
+
+
+def perform_search(artists=None, shows=None, type=None, checkpoint=None, partial=False):
     global current_analysis_status
     if get_analysis_status() is not None:
         logging.warning('An analysis is already running')
         return
 
-    remove_outdated_releases_from_db()
+    scan_started = time.time()
+    metrics_before = metrics.snapshot() if metrics.enabled else None
+
+    removed = remove_outdated_releases_from_db()
 
     if artists is None:
         artists = db_artists.all()
@@ -348,56 +794,101 @@ def perform_search(artists=None, shows=None, type=None):
     if shows is None:
         shows = db_shows.all()
 
-    current_artist = 1
-    current_show = 1
-    total_artists = len(artists)
-    total_shows = len(shows)
+    if type is not None and type != 'releases':
+        artists = []
+
+    if type is not None and type != 'episodes':
+        shows = []
 
     current_analysis_status = {
         'scan_running': True,
-        'current_artist': current_artist,
-        'total_artists': total_artists,
-        'current_show': current_show,
-        'total_shows': total_shows
+        'current_artist': 0,
+        'total_artists': len(artists),
+        'current_show': 0,
+        'total_shows': len(shows)
     }
 
-    loop.run_until_complete(ws_manager.broadcast(current_analysis_status))
+    # A failed scan keeps its checkpoint, the status is reset so that the next request can resume it
+    try:
+        ws_manager.publish(dict(current_analysis_status))
 
-    if type is None or type == 'releases' :
-        new_releases = []
-        for artist in artists:
-            current_analysis_status['current_artist'] = current_artist
-            current_analysis_status['total_artists'] = total_artists
+        is_resumed = checkpoint is not None
 
-            current_artist = current_artist + 1
-            new_releases.append(get_from_api(type='releases', item=artist))
+        if checkpoint is None:
+            checkpoint = {
+                'id': str(uuid.uuid4()),
+                'type': type,
+                'started_timestamp': scan_started,
+                'artists': [artist.get('id') for artist in artists],
+                'shows': [show.get('id') for show in shows],
+                'done_artists': [],
+                'done_shows': []
+            }
 
-            loop.run_until_complete(ws_manager.broadcast(current_analysis_status))
-            time.sleep(params.get('delay'))
+        save_scan_checkpoint(checkpoint)
 
-        save_releases_to_database(items=new_releases, type='releases')
+        results = {'releases': [], 'episodes': []}
+        added = {'releases': [], 'episodes': []}
+        previous_scan_states = {state.get('id'): state for state in db_scan_state.all()}
+        new_scan_states = []
 
-    if type is None or type == 'episodes' :
-        new_episodes = []
-        for show in shows:
-            current_analysis_status['current_show'] = current_show
-            current_analysis_status['total_shows'] = total_shows
+        with ThreadPoolExecutor(max_workers=max(1, params.get('max_concurrency'))) as executor:
+            futures = {executor.submit(scan_item, type='releases', item=artist,
+                                       previous_state=previous_scan_states.get(artist.get('id'))): ('releases', artist)
+                       for artist in artists}
+            futures.update({executor.submit(scan_item, type='episodes', item=show): ('episodes', show)
+                            for show in shows})
 
-            current_show = current_show + 1
-            new_episodes.append(get_from_api(type='episodes', item=show))
+            for future in as_completed(futures):
+                result, scan_state = future.result()
+                # A done future holds its raw result, it is released once the result is batched
+                result_type, item = futures.pop(future)
 
-            loop.run_until_complete(ws_manager.broadcast(current_analysis_status))
-            time.sleep(params.get('delay'))
+                if scan_state is not None:
+                    new_scan_states.append(scan_state)
+
+                results[result_type].append(result)
+
+                if result_type == 'releases':
+                    current_analysis_status['current_artist'] = current_analysis_status['current_artist'] + 1
+                else:
+                    current_analysis_status['current_show'] = current_analysis_status['current_show'] + 1
 
-        save_releases_to_database(items=new_episodes, type='episodes')
+                # A cancelled item is not done, a resumed scan goes through it again
+                if not scan_cancelled.is_set():
+                    checkpoint['done_artists' if result_type == 'releases' else 'done_shows'].append(item.get('id'))
 
-    update_metadata()
+                # Results are saved as the scan goes, a restart only loses the current batch
+                if len(results.get('releases')) + len(results.get('episodes')) >= params.get('scan_batch_size'):
+                    save_scan_batch(checkpoint, results, new_scan_states, added)
 
-    rss_feed_generator.generate_feed()
+                ws_manager.publish(dict(current_analysis_status))
 
-    current_analysis_status['scan_running'] = False
-    loop.run_until_complete(ws_manager.broadcast(current_analysis_status))
-    current_analysis_status = None
+        save_scan_batch(checkpoint, results, new_scan_states, added)
+        save_scan_checkpoint(None)
+
+        is_unchanged = not is_resumed and all(len(removed.get(key)) + len(added.get(key)) == 0 for key in added)
+
+        # A new generation invalidates every cached page, targeted rescans that found nothing keep the current one
+        if not (partial and is_unchanged):
+            update_metadata()
+
+            # What the interrupted part of a resumed scan changed is unknown, every feed is rendered again
+            with metrics.timer('render_duration_seconds', target='feeds'):
+                rss_feed_generator.generate_feed(
+                    changed=None if is_resumed else {key: removed.get(key) + added.get(key) for key in added})
+
+            with metrics.timer('render_duration_seconds', target='pages'):
+                page_renderer.generate_pages()
+
+        if metrics.enabled:
+            metrics.observe('scan_duration_seconds', time.time() - scan_started, type=type or 'all')
+            save_scan_summary(scan_started, metrics_before, type=type, artists=len(artists), shows=len(shows),
+                              removed=removed, added=added)
+    finally:
+        current_analysis_status['scan_running'] = False
+        ws_manager.publish(dict(current_analysis_status))
+        current_analysis_status = None
 
 
 def get_artists():
@@ -409,42 +900,93 @@ def get_releases():
 
 
 def get_metadata():
-    if db_metadata.all() is not None and len(db_metadata.all()) > 0:
-        return db_metadata.all()[0]
+    metadata = db_metadata.all()
+
+    if metadata is not None and len(metadata) > 0:
+        return metadata[0]
     else:
         return None
 
 
+def save_scan_summary(scan_started, metrics_before, type, artists, shows, removed, added):
+    metrics_after = metrics.snapshot()
+
+    def delta(name, **labels):
+        return get_total(metrics_after, name, **labels) - get_total(metrics_before, name, **labels)
+
+    summary = {
+        'id': str(uuid.uuid4()),
+        'added_date_timestamp': scan_started,
+        'date': datetime.datetime.fromtimestamp(scan_started).strftime('%Y-%m-%d - %H:%M'),
+        'duration': round(time.time() - scan_started, 3),
+        'type': type,
+        'artists': artists,
+        'shows': shows,
+        'requests': delta('spotify_requests_total'),
+        'throttled_requests': delta('spotify_requests_total', status=429),
+        'unauthorized_requests': delta('spotify_requests_total', status=401),
+        'failed_requests': delta('spotify_requests_total', status='error'),
+        'pages': delta('spotify_pages_total'),
+        'pages_per_artist': round(delta('spotify_pages_total', type='releases') / artists, 2) if artists > 0 else 0,
+        'new_releases': len(added.get('releases')),
+        'new_episodes': len(added.get('episodes')),
+        'removed_releases': len(removed.get('releases')),
+        'removed_episodes': len(removed.get('episodes')),
+        'spotify_seconds': round(delta('spotify_request_duration_seconds'), 3),
+        'ingest_seconds': round(delta('ingest_duration_seconds'), 3),
+        'render_seconds': round(delta('render_duration_seconds'), 3)
+    }
+
+    db_scan_history.insert(summary)
+    logging.info(f'Scan summary : {summary}')
+
+    oldest_kept = db_scan_history.page(sort_by='added_date_timestamp', reverse=True, offset=SCAN_HISTORY_SIZE - 1,
+                                       limit=1)
+
+    if len(oldest_kept) > 0:
+        db_scan_history.remove_older_than('added_date_timestamp', oldest_kept[0].get('added_date_timestamp'))
+
+
+def get_scan_history(limit=None):
+    return db_scan_history.page(sort_by='added_date_timestamp', reverse=True, limit=limit)
+
+
+def get_metrics():
+    return metrics
+
+
 def update_metadata():
     current_date = datetime.datetime.now()
-    db_root_metadata.drop_table('metadata')
+    db_metadata.truncate()
 
     metadata_object = {
         'last_execution_timestamp': current_date.timestamp(),
         'last_execution': current_date.strftime('%Y-%m-%d - %H:%M'),
-        'nb_artists': len(get_artists()),
-        'nb_releases': len(get_releases()),
-        'nb_shows': len(get_shows()),
-        'nb_episodes': len(get_episodes())
+        'nb_artists': db_artists.count(),
+        'nb_releases': db_releases.count(),
+        'nb_shows': db_shows.count(),
+        'nb_episodes': db_episodes.count()
     }
 
     db_metadata.insert(metadata_object)
 
 
 def get_releases_from_date(date, type, default_sorting=None):
-    start_date = date.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-    end_date = date.replace(hour=23, minute=59, second=59, microsecond=0).timestamp()
+    start_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = date.replace(hour=23, minute=59, second=59, microsecond=0)
 
-    db_root, db = get_databases().get(type)
+    return get_releases_between(start_date, end_date, type=type, default_sorting=default_sorting)
 
-    q = Query()
+
+def get_releases_between(start_date, end_date, type, default_sorting=None, limit=None):
+    db = get_databases().get(type)
 
     if default_sorting == 'added_date_timestamp' or default_sorting is None:
-        reference_date = q.added_date_timestamp
+        reference_date = 'added_date_timestamp'
     else:
-        reference_date = q.release_date_timestamp
+        reference_date = 'release_date_timestamp'
 
-    return db.search((reference_date >= start_date) & (reference_date <= end_date))
+    return db.search_range(reference_date, start_date.timestamp(), end_date.timestamp(), limit=limit)
 
 
 def get_parameters():
@@ -452,14 +994,7 @@ def get_parameters():
 
 
 def get_databases():
-    return {
-        'users': (db_root_users, db_users),
-        'artists': (db_root_artists, db_artists),
-        'releases': (db_root_releases, db_releases),
-        'metadata': (db_root_metadata, db_metadata),
-        'shows': (db_root_shows, db_shows),
-        'episodes': (db_root_episodes, db_episodes)
-    }
+    return databases
 
 
 def get_shows():
@@ -470,5 +1005,23 @@ def get_episodes():
     return db_episodes.all()
 
 
+def get_page(type, offset=0, limit=None, sort_by=None, reverse_sort=False, fields=None):
+    documents = get_databases().get(type).page(sort_by=sort_by, reverse=reverse_sort, offset=offset, limit=limit)
+
+    if fields is not None:
+        tree = storage.get_field_tree(fields)
+        documents = [storage.project_tree(document, tree) for document in documents]
+
+    return documents
+
+
 def get_ws_manager():
     return ws_manager
+
+
+scan_coordinator = ScanCoordinator(scan_function=perform_requested_search, cancel_function=cancel_search,
+                                   reset_function=reset_cancellation)
+
+
+def get_scan_coordinator():
+    return scan_coordinator
@@ -1,16 +1,28 @@
+import asyncio
+import atexit
+import io
+import subprocess
+import sys
+import tempfile
+import time
+
 import uvicorn
-from fastapi import FastAPI, Response, Request, BackgroundTasks
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Response, Request, Query
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 
 import spotify_api_helpers as api
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
 
+import data_transfer
+import metrics
+import page_renderer
 import rss_feed_generator
+import scan_worker
+from response_cache import ResponseCache
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -18,6 +30,118 @@ templates = Jinja2Templates(directory="./templates")
 
 params = api.get_parameters()
 logging = params.get_logger()
+response_cache = ResponseCache()
+
+
+def is_worker_mode():
+    return params.get('scan_mode') == 'worker'
+
+
+def send_scan_command(command, **kwargs):
+    if not is_worker_mode():
+        return {
+            'start': api.get_scan_coordinator().request_scan,
+            'cancel': api.get_scan_coordinator().cancel
+        }.get(command)(**kwargs)
+
+    try:
+        return scan_worker.send_command(command, **kwargs)
+    except (OSError, EOFError) as e:
+        logging.error(f'Scan worker unreachable - {e}')
+        return None
+
+
+async def cached_response(request, build, variant=None, page=None):
+    # The scan status may come from the worker process and builds read the database, the event loop never waits
+    return await run_in_threadpool(get_cached_response, request, build, variant, page)
+
+
+def get_cached_response(request, build, variant=None, page=None):
+    metadata = api.get_metadata()
+
+    # Pages display the scan progress, they are only cached between scans
+    if metadata is None or get_scan_status() is not None:
+        return build()
+
+    generation = metadata.get('last_execution_timestamp')
+
+    def build_from_page():
+        content = page_renderer.read_page(*page, generation=generation)
+        return build() if content is None else HTMLResponse(content)
+
+    return response_cache.respond(request, generation, build if page is None else build_from_page, variant=variant)
+
+
+async def list_response(request, type, offset=None, limit=None, sort_by=None, reverse_sort='false', fields=None):
+    def build():
+        try:
+            items = api.get_page(type, offset=0 if offset is None else offset, limit=limit, sort_by=sort_by,
+                                 reverse_sort=reverse_sort == 'true',
+                                 fields=None if fields is None else fields.split(','))
+        except ValueError as e:
+            return JSONResponse({'message': str(e)}, status_code=400)
+
+        # Without pagination the whole list is returned, as it always was
+        if offset is None and limit is None:
+            return items
+
+        return {
+            'items': items,
+            'total': api.get_databases().get(type).count(),
+            'offset': 0 if offset is None else offset,
+            'limit': limit
+        }
+
+    return await cached_response(request, build)
+
+
+def get_scan_status():
+    if not is_worker_mode():
+        return api.get_analysis_status()
+
+    try:
+        return scan_worker.send_command('status')
+    except (OSError, EOFError) as e:
+        logging.error(f'Scan worker unreachable - {e}')
+        return None
+
+
+async def relay_worker_status():
+    last_status = None
+
+    while True:
+        status = await run_in_threadpool(get_scan_status)
+
+        if status != last_status and (status is not None or last_status is not None):
+            api.get_ws_manager().publish(status if status is not None else {'scan_running': False})
+
+        last_status = status
+        await asyncio.sleep(1)
+
+
+if api.get_metrics().enabled:
+    @app.middleware('http')
+    async def measure_request(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+
+        # The route template keeps one series per endpoint whatever the ids in the url
+        route = request.scope.get('route')
+        path = route.path if route is not None else 'unmatched'
+
+        api.get_metrics().observe('http_request_duration_seconds', time.perf_counter() - start, route=path)
+        api.get_metrics().inc('http_requests_total', route=path, method=request.method, status=response.status_code)
+
+        return response
+
+
+@app.on_event('startup')
+async def startup():
+    api.get_ws_manager().bind(asyncio.get_running_loop())
+
+    # The scan runs in another process, its progress is polled to feed this process websockets
+    if is_worker_mode():
+        asyncio.create_task(relay_worker_status())
 
 
 @app.get('/login', response_class=RedirectResponse, status_code=302)
@@ -26,7 +150,7 @@ async def login():
 
 
 @app.get('/auth')
-async def auth(response: Response, background_tasks: BackgroundTasks, code, state):
+async def auth(response: Response, code, state):
     if state is None:
         response.status_code = 400
 
@@ -40,7 +164,7 @@ async def auth(response: Response, background_tasks: BackgroundTasks, code, stat
         return RedirectResponse(api.get_authorization_code_url())
     else:
         try:
-            background_tasks.add_task(api.perform_full_search)
+            await run_in_threadpool(send_scan_command, 'start')
         except PermissionError as e:
             logging.critical(f'Cannot re-authenticate user : {e}')
             return RedirectResponse('/login')
@@ -49,86 +173,106 @@ async def auth(response: Response, background_tasks: BackgroundTasks, code, stat
 
 
 @app.get('/api/artists')
-async def artists():
-    return api.get_artists()
+async def artists(request: Request, offset: int = None, limit: int = None, sort_by=None, reverse_sort='false',
+                  fields=None):
+    return await list_response(request, 'artists', offset=offset, limit=limit, sort_by=sort_by,
+                               reverse_sort=reverse_sort, fields=fields)
 
 
 @app.get('/artists')
 async def artists(request: Request, sort_by='name', reverse_sort='false'):
-    return templates.TemplateResponse(name="artists.html.j2", request=request,
-                                      context={'artists': api.get_artists(),
-                                               'metadata': api.get_metadata(),
-                                               'status': api.get_analysis_status(),
-                                               'app_params': params.get_all(),
-                                               'sort_by': sort_by,
-                                               'reverse_sort': reverse_sort == 'true'
-                                               }
-                                      )
+    def render():
+        return templates.TemplateResponse(name="artists.html.j2", request=request,
+                                          context={'artists': api.get_artists(),
+                                                   'metadata': api.get_metadata(),
+                                                   'status': get_scan_status(),
+                                                   'app_params': params.get_all(),
+                                                   'sort_by': sort_by,
+                                                   'reverse_sort': reverse_sort == 'true'
+                                                   }
+                                          )
+
+    return await cached_response(request, render)
 
 
 @app.get('/api/shows')
-async def shows():
-    return api.get_shows()
+async def shows(request: Request, offset: int = None, limit: int = None, sort_by=None, reverse_sort='false',
+                fields=None):
+    return await list_response(request, 'shows', offset=offset, limit=limit, sort_by=sort_by,
+                               reverse_sort=reverse_sort, fields=fields)
 
 
 @app.get('/shows')
 async def shows(request: Request, sort_by='show.name', reverse_sort='false'):
-    return templates.TemplateResponse(name="shows.html.j2", request=request,
-                                      context={'shows': api.get_shows(),
-                                               'metadata': api.get_metadata(),
-                                               'status': api.get_analysis_status(),
-                                               'app_params': params.get_all(),
-                                               'sort_by': sort_by,
-                                               'reverse_sort': reverse_sort == 'true'
-                                               }
-                                      )
+    def render():
+        return templates.TemplateResponse(name="shows.html.j2", request=request,
+                                          context={'shows': api.get_shows(),
+                                                   'metadata': api.get_metadata(),
+                                                   'status': get_scan_status(),
+                                                   'app_params': params.get_all(),
+                                                   'sort_by': sort_by,
+                                                   'reverse_sort': reverse_sort == 'true'
+                                                   }
+                                          )
+
+    return await cached_response(request, render)
 
 
 @app.get('/api/episodes')
-async def episodes():
-    return api.get_episodes()
+async def episodes(request: Request, offset: int = None, limit: int = None, sort_by=None, reverse_sort='false',
+                   fields=None):
+    return await list_response(request, 'episodes', offset=offset, limit=limit, sort_by=sort_by,
+                               reverse_sort=reverse_sort, fields=fields)
 
 
 @app.get('/episodes')
 async def episodes(request: Request, sort_by=api.get_parameters().get("default_sorting"), reverse_sort='true'):
-    return templates.TemplateResponse(name="episodes.html.j2", request=request,
-                                      context={'episodes': api.get_episodes(),
-                                               'metadata': api.get_metadata(),
-                                               'shows': api.get_shows(),
-                                               'status': api.get_analysis_status(),
-                                               'app_params': params.get_all(),
-                                               'sort_by': sort_by,
-                                               'reverse_sort': reverse_sort == 'true'
-                                               }
-                                      )
+    def render():
+        return templates.TemplateResponse(name="episodes.html.j2", request=request,
+                                          context={'episodes': api.get_episodes(),
+                                                   'metadata': api.get_metadata(),
+                                                   'shows': api.get_shows(),
+                                                   'status': get_scan_status(),
+                                                   'app_params': params.get_all(),
+                                                   'sort_by': sort_by,
+                                                   'reverse_sort': reverse_sort == 'true'
+                                                   }
+                                          )
+
+    return await cached_response(request, render, page=('episodes', sort_by, reverse_sort == 'true'))
 
 
 @app.get('/api/releases')
-async def releases():
-    return api.get_releases()
+async def releases(request: Request, offset: int = None, limit: int = None, sort_by=None, reverse_sort='false',
+                   fields=None):
+    return await list_response(request, 'releases', offset=offset, limit=limit, sort_by=sort_by,
+                               reverse_sort=reverse_sort, fields=fields)
 
 
 @app.get('/releases')
 async def releases(request: Request, sort_by=api.get_parameters().get("default_sorting"), reverse_sort='true'):
-    return templates.TemplateResponse(name="releases.html.j2", request=request,
-                                      context={'artists': api.get_artists(),
-                                               'releases': api.get_releases(),
-                                               'metadata': api.get_metadata(),
-                                               'app_params': params.get_all(),
-                                               'status': api.get_analysis_status(),
-                                               'sort_by': sort_by,
-                                               'reverse_sort': reverse_sort == 'true'
-                                               }
-                                      )
+    def render():
+        return templates.TemplateResponse(name="releases.html.j2", request=request,
+                                          context={'artists': api.get_artists(),
+                                                   'releases': api.get_releases(),
+                                                   'metadata': api.get_metadata(),
+                                                   'app_params': params.get_all(),
+                                                   'status': get_scan_status(),
+                                                   'sort_by': sort_by,
+                                                   'reverse_sort': reverse_sort == 'true'
+                                                   }
+                                          )
+
+    return await cached_response(request, render, page=('releases', sort_by, reverse_sort == 'true'))
 
 
 @app.get('/refresh')
-async def refresh(background_tasks: BackgroundTasks, request: Request):
+async def refresh(request: Request):
     try:
         if api.get_user_stored_token() is None:
             return RedirectResponse('/login')
 
-        background_tasks.add_task(api.perform_full_search)
+        await run_in_threadpool(send_scan_command, 'start')
     except PermissionError as e:
         logging.critical(e)
         return RedirectResponse('/login')
@@ -142,7 +286,8 @@ async def refresh(background_tasks: BackgroundTasks, request: Request):
 
 
 @app.get('/api/refresh')
-async def refresh(background_tasks: BackgroundTasks, request: Request, response: Response, type=None):
+async def refresh(request: Request, response: Response, type=None, artists=None, shows=None,
+                  followed_within: int = None):
 
     try:
         accepted_types = ['episodes', 'releases']
@@ -159,36 +304,124 @@ async def refresh(background_tasks: BackgroundTasks, request: Request, response:
             response.status_code = 400
             return {'message': 'no user logged'}
 
-        background_tasks.add_task(api.perform_full_search, type=type)
+        return await run_in_threadpool(send_scan_command, 'start', type=type,
+                                       artists=None if artists is None else artists.split(','),
+                                       shows=None if shows is None else shows.split(','),
+                                       followed_within=followed_within)
     except PermissionError as e:
         logging.critical(e)
         response.status_code = 400
         return {'message': str(e)}
 
-    return None
+
+@app.get('/api/cancel')
+async def cancel():
+    return {'cancelled': await run_in_threadpool(send_scan_command, 'cancel') is True}
 
 
 @app.get('/api/latest')
-async def from_date(date=None, default_sorting=None):
-    return get_all_latest_releases(date=date, default_sorting=default_sorting)
+async def from_date(response: Response, date=None, default_sorting=None, date_from: str = Query(None, alias='from'),
+                    date_to: str = Query(None, alias='to'), limit: int = None):
+    try:
+        return get_all_latest_releases(date=date, default_sorting=default_sorting, date_from=date_from,
+                                       date_to=date_to, limit=limit)
+    except ValueError as e:
+        response.status_code = 400
+        return {'message': str(e)}
 
-def get_all_latest_releases(date=None, default_sorting=None):
-    if date is None:
-        date = datetime.now()
-    else:
-        date = datetime.strptime(date, '%Y-%m-%d')
 
+def get_all_latest_releases(date=None, default_sorting=None, date_from=None, date_to=None, limit=None):
     if default_sorting not in params.get_metadata().get('fixed_values').get('default_sorting'):
         default_sorting = params.get('default_sorting')
 
+    if date_from is not None or date_to is not None:
+        start_date = datetime.fromtimestamp(0) if date_from is None else datetime.strptime(date_from, '%Y-%m-%d')
+        end_date = datetime.now() if date_to is None else datetime.strptime(date_to, '%Y-%m-%d')
+    else:
+        start_date = datetime.now() if date is None else datetime.strptime(date, '%Y-%m-%d')
+        end_date = start_date
+
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=0)
+
     return {
-        'releases': api.get_releases_from_date(date, type='releases', default_sorting=default_sorting),
-        'episodes': api.get_releases_from_date(date, type='episodes', default_sorting=default_sorting),
+        'releases': api.get_releases_between(start_date, end_date, type='releases', default_sorting=default_sorting,
+                                             limit=limit),
+        'episodes': api.get_releases_between(start_date, end_date, type='episodes', default_sorting=default_sorting,
+                                             limit=limit),
         'metadata': api.get_metadata(),
         'default_sorting': default_sorting
     }
 
 
+@app.get('/api/export')
+async def export(response: Response, tables=None):
+    try:
+        tables = None if tables is None else data_transfer.get_tables(tables.split(','))
+    except ValueError as e:
+        response.status_code = 400
+        return {'message': str(e)}
+
+    return StreamingResponse(data_transfer.export_lines(tables), media_type='application/x-ndjson',
+                             headers={'Content-Disposition': 'attachment; filename="spotify_tracker.ndjson"'})
+
+
+@app.post('/api/import')
+async def import_data(request: Request, response: Response):
+    if not params.get('api_import'):
+        response.status_code = 403
+        return {'message': 'api_import is disabled in params.ini'}
+
+    if await run_in_threadpool(get_scan_status) is not None:
+        response.status_code = 409
+        return {'message': 'a scan is running'}
+
+    # The body is spooled to disk, large imports never sit in memory
+    with tempfile.TemporaryFile() as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+
+        body.seek(0)
+
+        try:
+            return {'imported': await run_in_threadpool(data_transfer.import_lines,
+                                                        io.TextIOWrapper(body, encoding='utf-8'))}
+        except (ValueError, UnicodeDecodeError) as e:
+            response.status_code = 400
+            return {'message': str(e)}
+
+
+@app.get('/metrics')
+async def get_metrics(response: Response):
+    if not api.get_metrics().enabled:
+        response.status_code = 404
+        return {'message': 'metrics are disabled in params.ini'}
+
+    snapshots = [api.get_metrics().snapshot()]
+
+    # Scans run in the worker process, so do their measures
+    if is_worker_mode():
+        try:
+            worker_snapshot = await run_in_threadpool(scan_worker.send_command, 'metrics')
+        except (OSError, EOFError) as e:
+            logging.error(f'Scan worker unreachable - {e}')
+            worker_snapshot = None
+
+        if worker_snapshot is not None:
+            snapshots.append(worker_snapshot)
+
+    return PlainTextResponse(metrics.render(metrics.merge(*snapshots)), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/api/scans')
+async def scans(response: Response, limit: int = 20):
+    try:
+        return api.get_scan_history(limit=limit)
+    except ValueError as e:
+        response.status_code = 400
+        return {'message': str(e)}
+
+
 @app.websocket("/ws/refresh_status")
 async def websocket_endpoint(websocket: WebSocket):
     await api.get_ws_manager().connect(websocket)
@@ -201,22 +434,41 @@ async def websocket_endpoint(websocket: WebSocket):
 
 @app.get('/')
 async def landing_page(request: Request):
-    return templates.TemplateResponse(name="landing_page.html.j2", request=request,
-                                      context={
-                                          'metadata': api.get_metadata(),
-                                          'app_params': params.get_all(),
-                                          'user': api.get_user_stored_token(refresh=False) is not None,
-                                          'latest': get_all_latest_releases(date=None),
-                                          'status': api.get_analysis_status()
-                                      })
+    def render():
+        return templates.TemplateResponse(name="landing_page.html.j2", request=request,
+                                          context={
+                                              'metadata': api.get_metadata(),
+                                              'app_params': params.get_all(),
+                                              'user': api.get_user_stored_token(refresh=False) is not None,
+                                              'latest': get_all_latest_releases(date=None),
+                                              'status': get_scan_status()
+                                          })
+
+    # The landing page also depends on the current day and on the user being logged
+    return await cached_response(request, render,
+                           variant=(datetime.now().date(), api.get_user_stored_token(refresh=False) is not None))
 
 
 if __name__ == '__main__':
-    scheduler = BackgroundScheduler()
-    trigger = CronTrigger.from_crontab(params.get('cron'))
-    scheduler.add_job(api.perform_full_search, trigger)
-    scheduler.start()
+    web_workers = params.get('web_workers')
+
+    if is_worker_mode():
+        worker_process = subprocess.Popen([sys.executable, 'scan_worker.py'])
+        atexit.register(worker_process.terminate)
+    else:
+        scan_worker.start_scheduler()
+
+        if web_workers > 1:
+            logging.warning('params.ini : web_workers requires scan_mode=worker, fallback to a single web worker')
+            web_workers = 1
+
+    # Each web process keeps its own counters, the scraped values would depend on the process answering
+    if web_workers > 1 and params.get('metrics'):
+        logging.warning('params.ini : metrics requires a single web worker, fallback to a single web worker')
+        web_workers = 1
 
     rss_feed_generator.generate_feed()
+    page_renderer.generate_pages()
 
-    uvicorn.run(app, port=params.get('listen_port'), host=params.get('listen_host'))
+    uvicorn.run(app if web_workers == 1 else 'spotify_tracker_api:app', port=params.get('listen_port'),
+                host=params.get('listen_host'), workers=web_workers)
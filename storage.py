@@ -0,0 +1,401 @@
+import bisect
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from tinydb import TinyDB, Query
+
+TABLES = ['users', 'artists', 'releases', 'metadata', 'shows', 'episodes', 'scan_state', 'scan_history',
+          'scan_checkpoints']
+INDEXED_FIELDS = ['release_date_timestamp', 'added_date_timestamp']
+SQLITE_PATH = 'data/database.sqlite'
+
+
+def get_tinydb_path(name):
+    return f'data/database_{name}.json'
+
+
+def check_field(field):
+    if re.fullmatch(r'\w+(\.\w+)*', field) is None:
+        raise ValueError(f'Invalid field {field}')
+
+    return field
+
+
+def check_page(offset, limit):
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError('offset and limit must be positive')
+
+
+def get_field(document, field):
+    for key in field.split('.'):
+        document = document.get(key) if isinstance(document, dict) else None
+
+    return document
+
+
+def get_sort_key(value, field):
+    if isinstance(value, (dict, list)):
+        raise ValueError(f'{field} cannot be used for sorting')
+
+    # Same order as SQLite : numbers (booleans included) first, then text
+    return (1, value) if isinstance(value, str) else (0, value)
+
+
+def get_field_tree(fields):
+    tree = {}
+
+    for field in fields:
+        node = tree
+
+        for key in check_field(field).split('.'):
+            node = node.setdefault(key, {})
+
+    return tree
+
+
+def project_tree(value, tree):
+    # A leaf keeps the whole value, lists are projected item by item
+    if len(tree) == 0 or not isinstance(value, (dict, list)):
+        return value
+
+    if isinstance(value, list):
+        return [project_tree(item, tree) for item in value]
+
+    return {key: project_tree(value.get(key), subtree) for key, subtree in tree.items() if key in value}
+
+
+def project(document, fields):
+    return project_tree(document, get_field_tree(fields))
+
+
+class DateIndex:
+    def __init__(self, documents):
+        self.__timestamps = {}
+        self.__documents = {}
+
+        for field in INDEXED_FIELDS:
+            self.__set_entries(field, [(document.get(field), document) for document in documents])
+
+    def __set_entries(self, field, entries):
+        entries = sorted([entry for entry in entries if entry[0] is not None], key=lambda entry: entry[0])
+        self.__timestamps[field] = [entry[0] for entry in entries]
+        self.__documents[field] = [entry[1] for entry in entries]
+
+    def add(self, documents):
+        for field in INDEXED_FIELDS:
+            # Both lists are sorted runs, the sort only has to merge them
+            self.__set_entries(field, list(zip(self.__timestamps[field], self.__documents[field])) +
+                               [(document.get(field), document) for document in documents])
+
+    def remove(self, condition):
+        for field in INDEXED_FIELDS:
+            self.__set_entries(field, [entry for entry in zip(self.__timestamps[field], self.__documents[field])
+                                       if not condition(entry[1])])
+
+    def search_range(self, field, start, end):
+        timestamps = self.__timestamps[field]
+        return self.__documents[field][bisect.bisect_left(timestamps, start):bisect.bisect_right(timestamps, end)]
+
+
+class TinyDBTable:
+    def __init__(self, name):
+        self.name = name
+        self.__root = TinyDB(get_tinydb_path(name))
+        self.__table = self.__root.table(name, cache_size=0)
+
+        self.__date_index = None
+        self.__date_index_mtime = None
+        self.__date_index_lock = threading.Lock()
+
+    def __get_date_index(self):
+        # The file may have been written by another process since the index was built
+        mtime = os.path.getmtime(get_tinydb_path(self.name))
+
+        if self.__date_index is None or self.__date_index_mtime != mtime:
+            self.__date_index = DateIndex(self.__table.all())
+            self.__date_index_mtime = mtime
+
+        return self.__date_index
+
+    def __write(self, write, update_date_index):
+        with self.__date_index_lock:
+            is_index_fresh = self.__date_index_mtime == os.path.getmtime(get_tinydb_path(self.name))
+            result = write()
+
+            if self.__date_index is not None and is_index_fresh:
+                update_date_index(self.__date_index)
+                self.__date_index_mtime = os.path.getmtime(get_tinydb_path(self.name))
+            else:
+                self.__date_index = None
+
+        return result
+
+    def all(self):
+        return self.__table.all()
+
+    def count(self):
+        return len(self.__table)
+
+    def iterate(self, batch_size=1000):
+        # The json file is read at once anyway, documents are only handed out one by one
+        yield from self.__table.all()
+
+    def get_ids(self):
+        return {document.get('id') for document in self.__table.all()}
+
+    def insert(self, document):
+        return self.__table.insert(document)
+
+    def insert_multiple(self, documents):
+        return self.__write(lambda: self.__table.insert_multiple(documents),
+                            lambda index: index.add(documents))
+
+    def upsert_multiple(self, documents):
+        self.remove_ids([document.get('id') for document in documents])
+        return self.insert_multiple(documents)
+
+    def update(self, fields):
+        return self.__table.update(fields)
+
+    def truncate(self):
+        self.__table.truncate()
+
+    def page(self, sort_by=None, reverse=False, offset=0, limit=None):
+        check_page(offset, limit)
+        documents = self.__table.all()
+
+        if sort_by is not None:
+            check_field(sort_by)
+
+            # Documents without the field always come last, like with SQLite NULLS LAST
+            missing = [document for document in documents if get_field(document, sort_by) is None]
+            documents = sorted([document for document in documents if get_field(document, sort_by) is not None],
+                               key=lambda document: get_sort_key(get_field(document, sort_by), sort_by),
+                               reverse=reverse) + missing
+        elif reverse:
+            documents = documents[::-1]
+
+        return documents[offset:] if limit is None else documents[offset:offset + limit]
+
+    def search_range(self, field, start, end, limit=None):
+        check_page(0, limit)
+
+        with self.__date_index_lock:
+            documents = self.__get_date_index().search_range(field, start, end)
+
+        documents = documents[::-1]
+
+        return documents if limit is None else documents[:limit]
+
+    def remove_older_than(self, field, timestamp):
+        removed = self.__write(lambda: self.__table.remove(Query()[field] < timestamp),
+                               lambda index: index.remove(
+                                   lambda document: document.get(field) is not None and document.get(field) < timestamp))
+
+        return len(removed)
+
+    def remove_ids(self, ids):
+        ids = set(ids)
+
+        if len(ids) == 0:
+            return 0
+
+        removed = self.__write(lambda: self.__table.remove(Query().id.one_of(list(ids))),
+                               lambda index: index.remove(lambda document: document.get('id') in ids))
+
+        return len(removed)
+
+
+class SQLiteTable:
+    def __init__(self, connection, lock, name):
+        self.name = name
+        self.__connection = connection
+        self.__lock = lock
+
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {name} (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT, '
+                f'release_date_timestamp REAL, added_date_timestamp REAL, document TEXT NOT NULL)')
+            self.__connection.execute(f'CREATE INDEX IF NOT EXISTS {name}_id ON {name} (id)')
+
+            for field in INDEXED_FIELDS:
+                self.__connection.execute(f'CREATE INDEX IF NOT EXISTS {name}_{field} ON {name} ({field})')
+
+    def __select(self, where='', parameters=(), order_by='doc_id', limit=None, offset=0):
+        if limit is not None or offset > 0:
+            where = f'{where} ORDER BY {order_by} LIMIT ? OFFSET ?'
+            parameters = parameters + (-1 if limit is None else limit, offset)
+        else:
+            where = f'{where} ORDER BY {order_by}'
+
+        with self.__lock:
+            rows = self.__connection.execute(f'SELECT document FROM {self.name} {where}', parameters).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    @staticmethod
+    def __to_row(document):
+        return (document.get('id'), document.get('release_date_timestamp'), document.get('added_date_timestamp'),
+                json.dumps(document))
+
+    def all(self):
+        return self.__select()
+
+    def count(self):
+        with self.__lock:
+            return self.__connection.execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
+
+    def iterate(self, batch_size=1000):
+        last_doc_id = 0
+
+        while True:
+            with self.__lock:
+                rows = self.__connection.execute(
+                    f'SELECT doc_id, document FROM {self.name} WHERE doc_id > ? ORDER BY doc_id LIMIT ?',
+                    (last_doc_id, batch_size)).fetchall()
+
+            if len(rows) == 0:
+                return
+
+            for doc_id, document in rows:
+                yield json.loads(document)
+
+            last_doc_id = rows[-1][0]
+
+    def get_ids(self):
+        with self.__lock:
+            return {row[0] for row in self.__connection.execute(f'SELECT id FROM {self.name}')}
+
+    def insert(self, document):
+        return self.insert_multiple([document])[0]
+
+    def insert_multiple(self, documents):
+        doc_ids = []
+
+        with self.__lock, self.__connection:
+            for document in documents:
+                cursor = self.__connection.execute(
+                    f'INSERT INTO {self.name} (id, release_date_timestamp, added_date_timestamp, document) '
+                    f'VALUES (?, ?, ?, ?)', self.__to_row(document))
+                doc_ids.append(cursor.lastrowid)
+
+        return doc_ids
+
+    def upsert_multiple(self, documents):
+        with self.__lock, self.__connection:
+            self.__connection.executemany(f'DELETE FROM {self.name} WHERE id = ?',
+                                          [(document.get('id'),) for document in documents])
+            self.__connection.executemany(
+                f'INSERT INTO {self.name} (id, release_date_timestamp, added_date_timestamp, document) '
+                f'VALUES (?, ?, ?, ?)', [self.__to_row(document) for document in documents])
+
+        return [document.get('id') for document in documents]
+
+    def update(self, fields):
+        with self.__lock, self.__connection:
+            rows = self.__connection.execute(f'SELECT doc_id, document FROM {self.name}').fetchall()
+
+            for doc_id, document in rows:
+                self.__connection.execute(
+                    f'UPDATE {self.name} SET id = ?, release_date_timestamp = ?, added_date_timestamp = ?, '
+                    f'document = ? WHERE doc_id = ?', self.__to_row(json.loads(document) | fields) + (doc_id,))
+
+        return [row[0] for row in rows]
+
+    def truncate(self):
+        with self.__lock, self.__connection:
+            self.__connection.execute(f'DELETE FROM {self.name}')
+
+    def page(self, sort_by=None, reverse=False, offset=0, limit=None):
+        check_page(offset, limit)
+        direction = 'DESC' if reverse else 'ASC'
+
+        if sort_by is None:
+            order_by = f'doc_id {direction}'
+        else:
+            column = sort_by if sort_by in INDEXED_FIELDS else f"json_extract(document, '$.{check_field(sort_by)}')"
+
+            if sort_by not in INDEXED_FIELDS:
+                with self.__lock:
+                    not_sortable = self.__connection.execute(
+                        f"SELECT 1 FROM {self.name} WHERE json_type(document, '$.{sort_by}') IN ('array', 'object') "
+                        f"LIMIT 1").fetchone()
+
+                if not_sortable is not None:
+                    raise ValueError(f'{sort_by} cannot be used for sorting')
+            order_by = f'{column} {direction} NULLS LAST, doc_id'
+
+        return self.__select(order_by=order_by, limit=limit, offset=offset)
+
+    def search_range(self, field, start, end, limit=None):
+        check_page(0, limit)
+
+        if field not in INDEXED_FIELDS:
+            raise ValueError(f'{field} is not indexed')
+
+        return self.__select(f'WHERE {field} >= ? AND {field} <= ?', (start, end), order_by=f'{field} DESC',
+                             limit=limit)
+
+    def remove_older_than(self, field, timestamp):
+        if field not in INDEXED_FIELDS:
+            raise ValueError(f'{field} is not indexed')
+
+        with self.__lock, self.__connection:
+            return self.__connection.execute(f'DELETE FROM {self.name} WHERE {field} < ?', (timestamp,)).rowcount
+
+    def remove_ids(self, ids):
+        with self.__lock, self.__connection:
+            return self.__connection.executemany(f'DELETE FROM {self.name} WHERE id = ?',
+                                                 [(id,) for id in ids]).rowcount
+
+
+def open_tables(backend):
+    if backend == 'sqlite':
+        if not os.path.exists(SQLITE_PATH):
+            create_sqlite_database()
+
+        connection = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        lock = threading.Lock()
+
+        return {name: SQLiteTable(connection, lock, name) for name in TABLES}
+
+    return {name: TinyDBTable(name) for name in TABLES}
+
+
+def create_sqlite_database():
+    # The database is built aside and only moved into place once the migration is complete,
+    # an interrupted migration leaves no database and is started over on the next start
+    temporary_path = f'{SQLITE_PATH}.migrating'
+
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    connection = sqlite3.connect(temporary_path, check_same_thread=False)
+    lock = threading.Lock()
+
+    try:
+        migrated = migrate_from_tinydb({name: SQLiteTable(connection, lock, name) for name in TABLES})
+    finally:
+        connection.close()
+
+    os.replace(temporary_path, SQLITE_PATH)
+    logging.getLogger().info(f'TinyDB files migrated to {SQLITE_PATH} : {migrated}')
+
+
+def migrate_from_tinydb(tables):
+    migrated = {}
+
+    for name, table in tables.items():
+        if not os.path.exists(get_tinydb_path(name)) or os.path.getsize(get_tinydb_path(name)) == 0:
+            continue
+
+        documents = TinyDBTable(name).all()
+        table.truncate()
+        migrated[name] = len(table.insert_multiple(documents))
+
+    return migrated
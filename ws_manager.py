@@ -1,17 +1,75 @@
+import asyncio
+import threading
+import time
+from typing import List
+
 from fastapi import WebSocket, WebSocketDisconnect
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, max_rate=4, send_timeout=2):
         self.active_connections: List[WebSocket] = []
+        self.__interval = 0 if max_rate <= 0 else 1 / max_rate
+        self.__send_timeout = send_timeout
+        self.__loop = None
+        self.__lock = threading.Lock()
+        self.__pending = None
+        self.__flush_scheduled = False
+        self.__last_sent = 0
+        self.__sending = None
+
+    def bind(self, loop):
+        # Broadcasts always run on the web server loop, whatever thread publishes
+        self.__loop = loop
+        self.__sending = asyncio.Lock()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+
+    def publish(self, message: dict):
+        with self.__lock:
+            # Only the latest message is kept, intermediate progress is skipped
+            self.__pending = message
+
+            if self.__loop is None or self.__loop.is_closed() or self.__flush_scheduled:
+                return
+
+            self.__flush_scheduled = True
+
+        asyncio.run_coroutine_threadsafe(self.__flush(), self.__loop)
+
+    async def __flush(self):
+        delay = self.__last_sent + self.__interval - time.monotonic()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        with self.__lock:
+            message = self.__pending
+            self.__pending = None
+            self.__flush_scheduled = False
+
+        self.__last_sent = time.monotonic()
+
+        async with self.__sending:
+            await self.broadcast(message)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        connections = list(self.active_connections)
+        results = await asyncio.gather(*[asyncio.wait_for(connection.send_json(message), self.__send_timeout)
+                                         for connection in connections], return_exceptions=True)
+
+        # A slow or closed client is dropped instead of holding back the others
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.disconnect(connection)
+
+                try:
+                    await asyncio.wait_for(connection.close(), self.__send_timeout)
+                except Exception:
+                    pass